@@ -0,0 +1,142 @@
+from collections import deque
+from threading import Thread, Event
+
+import numpy as np
+from scipy.signal import resample_poly
+from madmom.audio.signal import Signal
+from madmom.features.beats import RNNBeatProcessor, DBNBeatTrackingProcessor
+
+import timing
+
+
+class StreamResampler:
+    """
+    Block-wise resample_poly that gives the same samples as resampling the whole stream: every block is resampled with
+    `pad` samples of context on both sides, which costs a latency of `pad` input samples.
+    """
+    def __init__(self, up: int, down: int, pad: int = None):
+        self.up = up
+        self.down = down
+        self.pad = pad if pad is not None else down  # A multiple of `down` so that the output indices stay integral
+        self.reset()
+
+    def reset(self):
+        self._pending = np.zeros(self.pad, dtype=np.float32)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        self._pending = np.concatenate((self._pending, x))
+        n = (len(self._pending) - 2 * self.pad) // self.down * self.down
+        if n <= 0:
+            return np.zeros(0, dtype=np.float32)
+        y = resample_poly(self._pending[:n + 2 * self.pad], self.up, self.down)
+        out = y[self.pad * self.up // self.down:(self.pad + n) * self.up // self.down]
+        self._pending = self._pending[n:]
+        return out.astype(np.float32)
+
+
+class AudioBeatTracker:
+    """
+    Online beat tracking of an audio stream with madmom's RNN beat activations and DBN beat tracker in online mode.
+    madmom's models expect 44.1 kHz, the stream is resampled and fed one 10 ms hop (441 samples) at a time.
+    feed() only queues a copy of the block, the networks run in their own thread. If the thread falls more than
+    `max_backlog_sec` behind, the backlog is dropped and the tracker restarts, so the CPU per block stays bounded.
+    beat_callback(t) receives each beat on the timing.now() clock.
+    The networks are restarted with the `reset` argument of their online process() calls, checked once at start-up by
+    warm_up().
+    """
+    SAMPLE_RATE = 44100
+    HOP = 441
+
+    def __init__(self, beat_callback, sr: int = 16000, max_backlog_sec: float = 0.5):
+        self.beat_callback = beat_callback
+        self.sr = sr
+        g = np.gcd(self.SAMPLE_RATE, sr)
+        self.resampler = StreamResampler(self.SAMPLE_RATE // g, sr // g)
+        self.rnn = RNNBeatProcessor(online=True)
+        self.dbn = DBNBeatTrackingProcessor(fps=self.SAMPLE_RATE / self.HOP, online=True)
+        self.max_backlog = int(max_backlog_sec * sr)
+        self._blocks = deque()
+        self._backlog = 0
+        self._event = Event()
+        self._running = False
+        self._thread = Thread()
+        self._hops = np.zeros(0, dtype=np.float32)
+        self._offset = None  # timing.now() - stream time of the latest block
+        self._n_in = 0
+        self._reset = True  # The next hop starts a new stream
+        self.warm_up()
+
+    def warm_up(self, n_hops: int = 100):
+        """
+        Runs the online call path on silence, hop by hop: loads the models and fails at start-up, not in the middle of
+        the beat demo, if the installed madmom does not give one activation per hop
+        """
+        hop = Signal(np.zeros(self.HOP, dtype=np.float32), sample_rate=self.SAMPLE_RATE)
+        for i in range(n_hops):
+            act = self.rnn.process(hop, reset=i == 0)
+            if np.size(act) != 1:
+                raise RuntimeError(f"madmom's online RNNBeatProcessor returned {np.size(act)} activations for one hop")
+            self.dbn.process(act, reset=i == 0)
+        self._reset = True
+
+    def start(self):
+        if self._running:
+            return
+        self.reset()
+        self._running = True
+        self._thread = Thread(target=self._process, name="AudioBeatTracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def reset(self):
+        self._blocks.clear()
+        self._backlog = 0
+        self.resampler.reset()
+        self._reset = True
+        self._hops = np.zeros(0, dtype=np.float32)
+        self._offset = None
+        self._n_in = 0
+
+    def feed(self, y: np.ndarray, *args):
+        """
+        Audio callback listener, y is a float32 block at `sr`
+        """
+        if not self._running:
+            return
+        self._blocks.append((y.copy(), timing.now()))
+        self._backlog += len(y)
+        self._event.set()
+
+    def _process(self):
+        while self._running:
+            self._event.wait()
+            self._event.clear()
+            if self._backlog > self.max_backlog:
+                print("Warning: audio beat tracker is behind, dropping the backlog")
+                self.reset()
+                continue
+            while self._blocks and self._running:
+                y, arrival = self._blocks.popleft()
+                self._backlog -= len(y)
+                self._n_in += len(y)
+                # Stream time of the block end against its arrival, the smallest seen has the least scheduling jitter
+                offset = arrival - self._n_in / self.sr
+                self._offset = offset if self._offset is None else min(self._offset, offset)
+                self._track(self.resampler.process(y))
+
+    def _track(self, x: np.ndarray):
+        self._hops = np.concatenate((self._hops, x))
+        n_hops = len(self._hops) // self.HOP
+        for i in range(n_hops):
+            hop = Signal(self._hops[i * self.HOP:(i + 1) * self.HOP], sample_rate=self.SAMPLE_RATE)
+            act = self.rnn.process(hop, reset=self._reset)
+            beats = self.dbn.process(act, reset=self._reset)
+            self._reset = False
+            for beat in np.atleast_1d(beats):
+                self.beat_callback(self._offset + float(beat))
+        self._hops = self._hops[n_hops * self.HOP:]
@@ -4,22 +4,42 @@ Date: 04/08/2022
 """
 
 import pyaudio
+import numpy as np
 import time
 
 
 class AudioDevice:
-    def __init__(self, callback_fn, rate=16000, frame_size=1024, input_dev_name='Universal Audio Thunderbolt', channels=1):
+    def __init__(self, callback_fn, rate=16000, frame_size=1024, input_dev_name='Universal Audio Thunderbolt', channels=1,
+                 channel_map=None):
+        """
+        channel_map: None passes the raw interleaved 16-bit bytes to callback_fn(in_data, frame_count, time_info, status).
+        Otherwise callback_fn(frame, frame_count, time_info, status) receives a float32 frame in [-1, 1) and returns the
+        pyaudio flag. See set_channel_map for the accepted maps. The frame is reused, copy it to keep it.
+        """
         self.input_device_id = -1
         self.callback_fn = callback_fn
+        self.rate = rate
+        self.channels = channels
+        self.frame_size = frame_size
+        self._gains = None
+        self._frame = np.zeros(frame_size, dtype=np.float32)
+        self._scratch = np.zeros(frame_size, dtype=np.float32)
+        self.listeners = []
+        self.set_channel_map(channel_map)
+        self.p = None
+        self.stream = None
+        self._open(input_dev_name)
+
+    def _open(self, input_dev_name):
         self.p = pyaudio.PyAudio()
         self._get_dev_id(input_dev_name)
 
         if self.input_device_id < 0:
             raise AssertionError("Input device not found")
 
-        self.stream = self.p.open(rate=rate, channels=channels, format=self.p.get_format_from_width(2), input=True,
-                                  output=False,
-                                  frames_per_buffer=frame_size,
+        self.stream = self.p.open(rate=self.rate, channels=self.channels, format=self.p.get_format_from_width(2),
+                                  input=True, output=False,
+                                  frames_per_buffer=self.frame_size,
                                   stream_callback=self._callback, input_device_index=self.input_device_id)
 
     def _get_dev_id(self, input_device_name):
@@ -30,8 +50,59 @@ class AudioDevice:
                 print(f"Found - {input_device_name} with id {i} for Input")
                 self.input_device_id = i
 
+    def set_channel_map(self, channel_map):
+        """
+        channel_map: a channel index, a list of channel indices to average or a dict of {channel index: gain} to downmix
+        """
+        if channel_map is None:
+            self._gains = None
+            return
+
+        if isinstance(channel_map, int):
+            channel_map = {channel_map: 1}
+        elif not isinstance(channel_map, dict):
+            channel_map = {ch: 1 / len(channel_map) for ch in channel_map}
+
+        for ch in channel_map:
+            if not 0 <= ch < self.channels:
+                raise ValueError(f"Channel {ch} not in the {self.channels} channel stream")
+        # The int16 scaling is folded into the gains so that each channel costs a single multiply
+        self._gains = [(ch, np.float32(gain / (1 << 15))) for ch, gain in channel_map.items()]
+
+    def to_float(self, in_data: bytes, frame_count: int) -> np.ndarray:
+        if frame_count > len(self._frame):
+            self._frame = np.zeros(frame_count, dtype=np.float32)
+            self._scratch = np.zeros(frame_count, dtype=np.float32)
+
+        x = np.frombuffer(in_data, dtype=np.int16)
+        frame = self._frame[:frame_count]
+        ch, gain = self._gains[0]
+        np.multiply(x[ch::self.channels], gain, out=frame, dtype=np.float32, casting='unsafe')
+        for ch, gain in self._gains[1:]:
+            scratch = self._scratch[:frame_count]
+            np.multiply(x[ch::self.channels], gain, out=scratch, dtype=np.float32, casting='unsafe')
+            np.add(frame, scratch, out=frame)
+        return frame
+
+    def add_listener(self, listener_fn):
+        """
+        listener_fn(frame, frame_count, time_info, status) also receives every float32 frame, after callback_fn.
+        Same rules as callback_fn: return quickly and copy the frame to keep it.
+        """
+        if listener_fn not in self.listeners:
+            self.listeners = self.listeners + [listener_fn]  # Replaced, not mutated, while the stream may be running
+
+    def remove_listener(self, listener_fn):
+        self.listeners = [fn for fn in self.listeners if fn != listener_fn]
+
     def _callback(self, in_data: bytes, frame_count: int, time_info: dict[str, float], status: int) -> tuple[bytes, int]:
-        return self.callback_fn(in_data, frame_count, time_info, status)
+        if self._gains is None:
+            return self.callback_fn(in_data, frame_count, time_info, status)
+        frame = self.to_float(in_data, frame_count)
+        flag = self.callback_fn(frame, frame_count, time_info, status)
+        for listener_fn in self.listeners:
+            listener_fn(frame, frame_count, time_info, status)
+        return in_data, flag
 
     def start(self):
         self.stream.start_stream()
@@ -3,89 +3,386 @@ Author: Raghavasimhan Sankaranarayanan
 Date: 04/08/2022
 """
 
+from collections import deque
 import librosa
 import madmom
 import numpy as np
 from pretty_midi import Note
+from tracer import get_tracer
+from raga import get_raga_table, SNAP
+
+# Transcribed phrase: one row per note, in onset order
+NOTE_DTYPE = np.dtype([('pitch', 'u1'), ('velocity', 'u1'), ('start', 'f8'), ('end', 'f8')])
+
+
+class OnsetDetector:
+    """
+    Block-wise CNN onset detection. The activation of a frame only depends on the 7 network frames on each side and on
+    half of the largest STFT window, so once that context is available it is final and is never recomputed.
+    Feeding a phrase block by block gives the same activations as processing it at once.
+    """
+    def __init__(self, hop_length=441, max_frame_size=4096, nn_context=7, min_chunk_frames=8, warm_up=True):
+        # Schlüter, Jan, and Sebastian Böck. "Improved musical onset detection with convolutional neural networks." 2014 ieee international conference on acoustics, speech and signal processing (icassp). IEEE, 2014.
+        self.processor = madmom.features.CNNOnsetProcessor()
+        self.hop_length = hop_length
+        self.context = nn_context + int(np.ceil(max_frame_size / (2 * hop_length)))
+        self.min_chunk_frames = min_chunk_frames
+        self._buffer = np.array([])
+        self._buffer_start = 0  # Sample index of self._buffer[0]
+        self._n_samples = 0
+        self._n_done = 0  # Number of frames with final activations
+        self._activations = []
+        self.reset()
+        if warm_up:
+            self.warm_up()
+
+    def warm_up(self, n_frames=100):
+        # Loads the network weights into cache and pays the first-call cost before the gig starts
+        self.processor(np.zeros(n_frames * self.hop_length))
+
+    def reset(self):
+        self._buffer = np.array([])
+        self._buffer_start = 0
+        self._n_samples = 0
+        self._n_done = 0
+        self._activations = []
+
+    def process(self, y):
+        self._buffer = np.concatenate((self._buffer, y))
+        self._n_samples += len(y)
+        n_final = self._n_samples // self.hop_length - self.context + 1
+        if n_final - self._n_done >= self.min_chunk_frames:
+            self._compute(n_final)
+
+    def finish(self):
+        if self._n_samples > self._n_done * self.hop_length:
+            self._compute()
+
+    def get_activations(self):
+        return np.hstack(self._activations) if self._activations else np.array([])
+
+    def get_onsets(self, threshold: float = 0.35, pre_max: int = 3, post_max: int = 3):
+        return self.pick_onsets(self.get_activations(), threshold=threshold, pre_max=pre_max, post_max=post_max)
+
+    def peek_onsets(self, threshold: float = 0.35, pre_max: int = 3, post_max: int = 3):
+        """
+        Onsets as get_onsets would return them after finish(), without finishing: the tail activations are computed
+        but not kept, so that more audio can still be processed.
+        """
+        act = self.get_activations()
+        if self._n_samples > self._n_done * self.hop_length:
+            first, tail = self._process_tail()
+            act = np.hstack((act, tail[self._n_done - first:]))
+        return self.pick_onsets(act, threshold=threshold, pre_max=pre_max, post_max=post_max)
+
+    def _process_tail(self):
+        # Restart `context` frames early so that the first new frame sees the same input as in the batch path
+        first = max(0, self._n_done - self.context)
+        return first, self.processor(self._buffer[first * self.hop_length - self._buffer_start:])
+
+    def _compute(self, n_final=None):
+        first, act = self._process_tail()
+        end = len(act) if n_final is None else n_final - first
+        self._activations.append(act[self._n_done - first: end])
+        self._n_done = first + end
+
+        keep = max(0, self._n_done - self.context) * self.hop_length
+        self._buffer = self._buffer[keep - self._buffer_start:]
+        self._buffer_start = keep
+
+    @staticmethod
+    def pick_onsets(act, threshold: float = 0.35, pre_max: int = 3, post_max: int = 3):
+        onsets = madmom.features.onsets.peak_picking(activations=act, threshold=threshold, pre_max=pre_max,
+                                                     post_max=post_max)
+        return np.unique(np.hstack([0, onsets])).astype(int)
 
 
 class AudioMidiConverter:
     def __init__(self, raga_map=None, root='D3', sr=16000, note_min='D2', note_max='A5', frame_size=2048,
-                 hop_length=441, outlier_coeff=2):
+                 hop_length=441, outlier_coeff=2, stream_chunk_frames=16, warm_up=True, raga_policy=SNAP,
+                 max_snap_cents=None, snap_f0=False, adaptive_range=False, range_margin=2, range_history=4,
+                 edge_ratio=0.1, min_voiced_ratio=0.5):
+        """
+        raga_map: name of a raga in raga.RAGAS, a 12 pitch class map or None to keep every note
+        raga_policy: 'snap' moves the notes to the nearest note of the raga, 'drop' removes the notes outside of it
+        snap_f0: snap every frame of the pitch curve before taking the medians instead of the medians only
+        adaptive_range: search pyin only around the register of the last `range_history` phrases, widened by
+            `range_margin` semitones and out to the next raga notes. The full range is used again for a phrase (or a
+            chunk) when more than `edge_ratio` of its voiced frames sit at the edges of the narrow range, or when it is
+            voiced less than `min_voiced_ratio` times as much as the recent phrases.
+        """
         self.fmin = librosa.note_to_hz(note_min)
         self.fmax = librosa.note_to_hz(note_max)
+        self.full_range = (self.fmin * 0.9, self.fmax * 1.1)
+        self.adaptive_range = adaptive_range
+        self.range_margin = range_margin
+        self.edge_ratio = edge_ratio
+        self.min_voiced_ratio = min_voiced_ratio
+        self.registers = deque(maxlen=range_history)  # (low, high) midi pitch and voiced ratio of the recent phrases
+        self.range_fallbacks = 0
+        self._range = self.full_range
         self.hop_length = hop_length
         self.frame_size = frame_size
-        self.raga_map = np.array(raga_map) if raga_map else None
         self.sr = sr
         self.root = librosa.note_to_midi(root)
+        self.raga_policy = raga_policy
+        self.max_snap_cents = max_snap_cents
+        self.snap_f0 = snap_f0
+        self.set_raga(raga_map)
         self.m = outlier_coeff
         self.empty_arr = np.array([])
-        # Schlüter, Jan, and Sebastian Böck. "Improved musical onset detection with convolutional neural networks." 2014 ieee international conference on acoustics, speech and signal processing (icassp). IEEE, 2014.
-        self.onset_processor = madmom.features.CNNOnsetProcessor()
+        self.onset_detector = OnsetDetector(hop_length=hop_length, warm_up=False)
+        self.tracer = get_tracer()
+        self.onset_processor = self.onset_detector.processor
+
+        # Streaming mode: pyin is run on chunks of at least `stream_chunk_frames` frames as the audio arrives
+        self.stream_chunk_frames = stream_chunk_frames
+        self._stream_pending = self.empty_arr
+        self._stream_f0 = []
+        self._stream_samples = 0
+        self._speculation = None  # (samples fed, f0, onsets) of the last speculate()
+        self.reset_stream()
+
+        if warm_up:
+            self.warm_up()
+
+    def set_raga(self, raga_map, root=None):
+        if root is not None:
+            self.root = librosa.note_to_midi(root) if isinstance(root, str) else root
+        self.raga_map = raga_map if raga_map is not None and len(raga_map) > 0 else None
+        self.raga_table = None
+        if self.raga_map is not None:
+            self.raga_table = get_raga_table(self.raga_map, self.root, policy=self.raga_policy,
+                                             max_snap_cents=self.max_snap_cents)
+
+    def warm_up(self):
+        # First calls of pyin (numba) and of the onset network are slow, get them out of the way at start-up
+        self._pyin(np.zeros(self.frame_size * 2), *self.full_range)
+        self.onset_detector.warm_up()
+
+    def convert(self, y, return_onsets=False, velocity=100, as_array=False):
+        self._range = self.pitch_range()
+        f0 = self._track(y, check_voicing=True)
+        self.tracer.mark("pyin")
+        onsets = self.get_onsets(y)
+        self.tracer.mark("onsets")
+        return self._to_notes(f0, onsets, return_onsets=return_onsets, velocity=velocity, as_array=as_array)
 
-    def convert(self, y, return_onsets=False, velocity=100):
-        f0, voiced_flag, voiced_prob = librosa.pyin(y, fmin=self.fmin * 0.9, fmax=self.fmax * 1.1, sr=self.sr,
-                                                    frame_length=self.frame_size, hop_length=self.hop_length)
+    def reset_stream(self):
+        self._range = self.pitch_range()
+        self.onset_detector.reset()
+        # Left padding equivalent to pyin(center=True) so that the frames line up with the batch path
+        self._stream_pending = np.zeros(self.frame_size // 2)
+        self._stream_f0 = []
+        self._stream_samples = 0
+        self._speculation = None
+
+    def process_block(self, y):
+        """
+        Feed the next block of the phrase. Pitch is tracked as soon as `stream_chunk_frames` full frames are available,
+        onsets as soon as their receptive field is complete.
+        """
+        self.onset_detector.process(y)
+        self._stream_samples += len(y)
+        self._stream_pending = np.concatenate((self._stream_pending, y))
+        n_frames = (len(self._stream_pending) - self.frame_size) // self.hop_length + 1
+        if n_frames >= self.stream_chunk_frames:
+            self._track_pitch(n_frames)
+
+    def finish_stream(self, return_onsets=False, velocity=100, as_array=False):
+        """
+        Track the pitch of the remaining tail and return the notes of the streamed phrase.
+        The result matches `convert` on the same audio within `notes_match` tolerance: frames and onsets are identical,
+        only the Viterbi decoding restarts at chunk boundaries.
+        If nothing was fed since the last speculate(), its pitch and onsets are used as they are.
+        """
+        if self._speculation is not None and self._speculation[0] == self._stream_samples:
+            _, f0, onsets = self._speculation
+            self.tracer.mark("speculation")
+        else:
+            f0 = np.hstack(self._stream_f0 + [self._tail_pitch()])
+            self.tracer.mark("pyin")
+            self.onset_detector.finish()
+            onsets = self.onset_detector.get_onsets()
+            self.tracer.mark("onsets")
+        self.reset_stream()
+        return self._to_notes(f0, onsets, return_onsets=return_onsets, velocity=velocity, as_array=as_array)
+
+    def speculate(self):
+        """
+        Track the pitch and onsets of the phrase so far as finish_stream would if the phrase ended now, without ending
+        the stream. Called while the player is silent, so that finish_stream only has the notes left to do.
+        """
+        if self._speculation is not None and self._speculation[0] == self._stream_samples:
+            return
+        f0 = np.hstack(self._stream_f0 + [self._tail_pitch()])
+        onsets = self.onset_detector.peek_onsets()
+        self._speculation = (self._stream_samples, f0, onsets)
+
+    def _tail_pitch(self):
+        # pyin of the frames not tracked yet, with the right padding of pyin(center=True). The pending audio is kept.
+        pending = np.concatenate((self._stream_pending, np.zeros(self.frame_size // 2)))
+        n_frames = (len(pending) - self.frame_size) // self.hop_length + 1
+        if n_frames <= 0:
+            return self.empty_arr
+        return self._track(pending[:(n_frames - 1) * self.hop_length + self.frame_size], center=False)
+
+    def _track_pitch(self, n_frames):
+        end = (n_frames - 1) * self.hop_length + self.frame_size
+        f0 = self._track(self._stream_pending[:end], center=False)
+        self._stream_f0.append(f0)
+        self._stream_pending = self._stream_pending[n_frames * self.hop_length:]
+
+    def _pyin(self, y, fmin, fmax, center=True):
+        f0, voiced_flag, _ = librosa.pyin(y, fmin=fmin, fmax=fmax, sr=self.sr, frame_length=self.frame_size,
+                                          hop_length=self.hop_length, center=center)
+        return f0, voiced_flag
+
+    def _track(self, y, center=True, check_voicing=False):
+        """
+        pyin over the current search range, again over the full range if the narrow result is not trusted. A fallback
+        keeps the full range until the end of the phrase.
+        """
+        f0, voiced_flag = self._pyin(y, *self._range, center=center)
+        if self._range != self.full_range and not self._trust(f0, voiced_flag, check_voicing):
+            self.range_fallbacks += 1
+            self._range = self.full_range
+            f0, voiced_flag = self._pyin(y, *self._range, center=center)
+        return f0
+
+    def _trust(self, f0, voiced_flag, check_voicing):
+        voiced = f0[voiced_flag & ~np.isnan(f0)]
+        if check_voicing and self.registers:
+            expected = np.mean([ratio for _, _, ratio in self.registers])
+            if len(voiced) < self.min_voiced_ratio * expected * len(f0):
+                return False
+        if len(voiced) == 0:
+            return True
+        lo, hi = librosa.hz_to_midi(np.array(self._range))
+        pitch = librosa.hz_to_midi(voiced)
+        return np.mean((pitch < lo + 0.5) | (pitch > hi - 0.5)) <= self.edge_ratio
+
+    def pitch_range(self):
+        """
+        (fmin, fmax) of the pyin search for the next phrase
+        """
+        if not self.adaptive_range or not self.registers:
+            return self.full_range
+        lo = min(low for low, _, _ in self.registers) - self.range_margin
+        hi = max(high for _, high, _ in self.registers) + self.range_margin
+        if self.raga_table is not None:  # Out to the raga notes around the register, and a semitone for gamakas
+            notes = self.raga_table.notes
+            lo = notes[max(np.searchsorted(notes, lo, side='right') - 1, 0)] - 1
+            hi = notes[min(np.searchsorted(notes, hi), len(notes) - 1)] + 1
+        fmin, fmax = librosa.midi_to_hz(np.array([lo, hi]))
+        return max(fmin, self.full_range[0]), min(fmax, self.full_range[1])
+
+    def _update_register(self, pitch):
+        voiced = pitch[pitch > 0]
+        if len(voiced) >= 10:
+            low, high = np.percentile(voiced, [5, 95])
+            self.registers.append((low, high, len(voiced) / len(pitch)))
+
+    def _to_notes(self, f0, onsets, return_onsets=False, velocity=100, as_array=False):
+        """
+        One note per onset with the median pitch of its segment. Returns a NOTE_DTYPE array if as_array, else a list of
+        pretty_midi.Note (see to_note_list)
+        """
         if len(f0) == 0:
             print("No f0")
+            notes = np.zeros(0, dtype=NOTE_DTYPE) if as_array else []
             if return_onsets:
-                return self.empty_arr, self.empty_arr
-            return self.empty_arr
+                return notes, self.empty_arr
+            return notes
 
         pitch = librosa.hz_to_midi(f0)
         pitch[np.isnan(pitch)] = 0
-        onsets = self.get_onsets(y)  # There is at-least one onset at [0]
-        print(onsets)
-        notes = np.zeros(len(onsets), dtype=int)
-        for i in range(len(onsets) - 1):
-            notes[i] = np.round(np.nanmedian(pitch[onsets[i]: onsets[i + 1]]))
-        notes[-1] = np.round(np.nanmedian(pitch[onsets[-1]:]))
+        self._update_register(pitch)
+        if self.snap_f0 and self.raga_table is not None:
+            snapped, keep = self.raga_table(pitch)
+            pitch = np.where(keep & (pitch > 0), snapped, 0).astype(float)
+        print(onsets)  # There is at-least one onset at [0]
+        medians = self.segment_medians(pitch, onsets)
 
-        onsets = onsets[notes > 0] * self.hop_length / self.sr
-        notes = notes[notes > 0]
+        voiced = medians >= 0.5
+        onsets = onsets[voiced] * self.hop_length / self.sr
+        notes = medians[voiced]
+
+        if self.raga_table is not None:
+            # The fractional medians are snapped to the raga, the onsets of dropped notes go with them
+            notes, keep = self.raga_table(notes)
+            notes, onsets = notes[keep].astype(int), onsets[keep]
+            self.tracer.mark("filter_raga")
+        else:
+            notes = np.round(notes).astype(int)
 
         if len(notes) > 0:
-            if self.raga_map is not None:
-                notes = self.filter_raga(notes)
             notes = self.fix_outliers(notes, m=self.m)
+            self.tracer.mark("fix_outliers")
         # bpm = self.get_tempo(y)
 
-        temp = []
-        for i in range(len(notes)):
-            temp.append(Note(velocity, notes[i], start=onsets[i], end=onsets[i] + 0.1))
+        arr = np.zeros(len(notes), dtype=NOTE_DTYPE)
+        arr['pitch'] = notes
+        arr['velocity'] = velocity
+        arr['start'] = onsets
+        arr['end'] = arr['start'] + 0.1
+        if not as_array:
+            arr = self.to_note_list(arr)
 
         if return_onsets:
-            return temp, onsets
+            return arr, onsets
+
+        return arr
+
+    @staticmethod
+    def segment_medians(pitch: np.ndarray, onsets: np.ndarray) -> np.ndarray:
+        """
+        Median of pitch[onsets[i]:onsets[i + 1]] for every onset (the last segment runs to the end), 0 for an
+        empty segment. All the segments are sorted at once: frames are ordered by (segment, pitch) and the medians are
+        read at the middle of each segment.
+        """
+        n = len(pitch)
+        bounds = np.minimum(onsets, n)
+        lengths = np.diff(np.append(bounds, n))
+        frames = np.arange(bounds[0], n)
+        segment = np.repeat(np.arange(len(bounds)), lengths)
+        ordered = pitch[frames[np.lexsort((pitch[frames], segment))]]
+
+        first = bounds - bounds[0]
+        lo = first + np.maximum(lengths - 1, 0) // 2
+        hi = first + lengths // 2
+        medians = np.zeros(len(bounds))
+        valid = lengths > 0
+        medians[valid] = (ordered[lo[valid]] + ordered[hi[valid]]) / 2
+        return medians
 
-        return temp
+    @staticmethod
+    def to_note_list(notes: np.ndarray) -> [Note]:
+        """
+        pretty_midi.Note objects of a NOTE_DTYPE array, only built when a consumer needs them
+        """
+        return [Note(int(velocity), int(pitch), start=float(start), end=float(end))
+                for pitch, velocity, start, end in notes.tolist()]
 
-    def filter_raga(self, _notes):
-        filtered_notes = _notes.copy()
-        _n = _notes - self.root
-        code = (_n + 12) % 12
-        # filtered_notes += self.raga_map[code] - code              # when raga_map is an index map
-        filtered_notes = filtered_notes[self.raga_map[code] == 1]  # when raga_map is 1, 0
-        return filtered_notes
+    def filter_raga(self, notes):
+        """
+        Notes in the raga, per raga_policy (see raga.RagaTable)
+        """
+        notes, keep = self.raga_table(notes)
+        return notes[keep]
 
     def get_onsets(self, y, threshold: float = 0.35, pre_max: int = 3, post_max: int = 3):
         act = self.onset_processor(y)
         # onsets = librosa.onset.onset_detect(y=y, sr=self.sr, hop_length=self.hop_length)
         # onsets = np.hstack([0, onsets])
-
-        onsets = madmom.features.onsets.peak_picking(activations=act, threshold=threshold, pre_max=pre_max,
-                                                     post_max=post_max)
-        return np.unique(np.hstack([0, onsets]))
-        # return np.unique(onsets)
+        return OnsetDetector.pick_onsets(act, threshold=threshold, pre_max=pre_max, post_max=post_max)
 
     @staticmethod
     def fix_outliers(arr, m=2):
         arr_mean = np.mean(arr)
         arr_std = m * np.std(arr)
-        for _i in range(len(arr)):
-            n = arr[_i]
-            if np.abs(n - arr_mean) > arr_std:
-                arr[_i] = AudioMidiConverter.shift_octave(arr[_i], arr_mean)
+        outliers = np.abs(arr - arr_mean) > arr_std
+        arr[outliers] = AudioMidiConverter.shift_octave(arr[outliers], arr_mean)
         return arr
 
     @staticmethod
@@ -95,6 +392,24 @@ class AudioMidiConverter:
         x = x // 2
         return val + ((x + res) * 12)
 
+    @staticmethod
+    def notes_match(notes, ref_notes, pitch_tol=1, onset_tol=0.03, min_ratio=0.9):
+        """
+        Tolerance used to compare the streaming and the batch transcription: same number of notes, every onset within
+        `onset_tol` seconds and at least `min_ratio` of the pitches within `pitch_tol` semitones.
+        """
+        if len(notes) != len(ref_notes):
+            return False
+        if len(notes) == 0:
+            return True
+        pitch = np.array([n.pitch for n in notes])
+        ref_pitch = np.array([n.pitch for n in ref_notes])
+        start = np.array([n.start for n in notes])
+        ref_start = np.array([n.start for n in ref_notes])
+        if np.any(np.abs(start - ref_start) > onset_tol):
+            return False
+        return np.mean(np.abs(pitch - ref_pitch) <= pitch_tol) >= min_ratio
+
     @staticmethod
     def get_tempo(y):
         return librosa.beat.tempo(y=y)[0]
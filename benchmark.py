@@ -0,0 +1,282 @@
+"""
+Benchmark of the audio to MIDI path on synthesized violin phrases, no hardware needed.
+
+python benchmark.py                          # all the benchmarks
+python benchmark.py --out results.json       # save the results
+python benchmark.py --baseline results.json  # compare with saved results
+
+Phrases are random walks in the raga (Bahudari in D by default) with vibrato, bow attacks and a little noise,
+so every run with the same seed transcribes the same audio. Accuracy is the F-measure of the transcribed notes against
+the synthesized ones: a note is correct if its onset is within `onset_tol` and its pitch is the same.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import librosa
+from pretty_midi import Note
+
+from audioToMidi import AudioMidiConverter
+from demos import Performer, Phrase, QnADemo
+from main import get_params
+
+
+class NullAudioDevice:
+    """
+    Stands in for AudioDevice so that QnADemo can be built without an audio interface
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def reset(self):
+        pass
+
+
+def synthesize_phrase(duration: float, raga_map, root: int = 50, sr: int = 16000, seed: int = 0,
+                      note_sec=(0.15, 0.6), n_harmonics: int = 8):
+    """
+    Returns the audio (float32) and the ground truth (midi pitches, onsets in seconds)
+    """
+    rng = np.random.default_rng(seed)
+    scale = np.array([p for p in range(root, root + 25) if raga_map[(p - root) % 12]])
+
+    pitches, onsets = [], []
+    t, idx = 0., len(scale) // 2
+    while t < duration - note_sec[0]:
+        idx = int(np.clip(idx + rng.integers(-2, 3), 0, len(scale) - 1))
+        pitches.append(scale[idx])
+        onsets.append(t)
+        t += rng.uniform(*note_sec)
+    pitches, onsets = np.array(pitches), np.array(onsets)
+
+    n = int(duration * sr)
+    time_axis = np.arange(n) / sr
+    note_idx = np.searchsorted(onsets, time_axis, side='right') - 1
+    since_onset = time_axis - onsets[note_idx]
+
+    vibrato = 0.25 * np.sin(2 * np.pi * 5.5 * time_axis) * np.minimum(since_onset / 0.2, 1)
+    f0 = librosa.midi_to_hz(pitches[note_idx] + vibrato)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    k = np.arange(1, n_harmonics + 1)[:, None]
+    y = np.sum(np.sin(k * phase) / k, axis=0)
+
+    envelope = np.minimum(since_onset / 0.03, 1) * (1 - 0.3 * np.minimum(since_onset / 0.3, 1))
+    y = 0.3 * y * envelope / np.max(np.abs(y)) + 0.002 * rng.standard_normal(n)
+    y[-int(0.05 * sr):] *= np.linspace(1, 0, int(0.05 * sr))
+    return y.astype(np.float32), (pitches, onsets)
+
+
+def note_accuracy(notes, onsets, ref_pitches, ref_onsets, onset_tol=0.05):
+    """
+    F-measure of the notes, matched greedily by onset
+    """
+    if len(notes) == 0 or len(ref_pitches) == 0:
+        return 0.
+    pitches = np.array([note.pitch for note in notes])
+    onsets = np.asarray(onsets)
+    used = np.zeros(len(onsets), dtype=bool)
+    correct = 0
+    for p, t in zip(ref_pitches, ref_onsets):
+        d = np.abs(onsets - t)
+        d[used] = np.inf
+        i = int(np.argmin(d))
+        if d[i] <= onset_tol:
+            used[i] = True
+            correct += pitches[i] == p
+    precision, recall = correct / len(onsets), correct / len(ref_pitches)
+    return 0. if correct == 0 else 2 * precision * recall / (precision + recall)
+
+
+def measure(fn, *args, repeat: int = 3):
+    """
+    Best wall time of `repeat` calls, peak traced memory of one more call (in MB) and the result of the last call
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = fn(*args)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak / 1e6, result
+
+
+def bench_convert(converter: AudioMidiConverter, raga_map, lengths, sr, repeat):
+    results = {}
+    for length in lengths:
+        y, (ref_pitches, ref_onsets) = synthesize_phrase(length, raga_map, sr=sr, seed=length)
+        sec, peak, (notes, onsets) = measure(converter.convert, y, True, repeat=repeat)
+        onset_sec, _, _ = measure(converter.get_onsets, y, repeat=repeat)
+        results[f"convert_{length}s"] = {"sec": sec, "peak_mb": peak, "rtf": sec / length, "onsets_sec": onset_sec,
+                                         "notes": len(notes), "ref_notes": len(ref_pitches),
+                                         "f_measure": note_accuracy(notes, onsets, ref_pitches, ref_onsets)}
+    return results
+
+
+def bench_adaptive(converter_params: dict, raga_map, lengths, sr, repeat, full_results: dict):
+    """
+    convert with the pyin range narrowed to the register of the previous phrases, against the full range results
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        converter = AudioMidiConverter(**converter_params, adaptive_range=True)
+        converter.convert(synthesize_phrase(5, raga_map, sr=sr, seed=100)[0])  # The register of a previous phrase
+
+    results = {}
+    for length in lengths:
+        y, (ref_pitches, ref_onsets) = synthesize_phrase(length, raga_map, sr=sr, seed=length)
+        fallbacks = converter.range_fallbacks
+        sec, peak, (notes, onsets) = measure(converter.convert, y, True, repeat=repeat)
+        f_measure = note_accuracy(notes, onsets, ref_pitches, ref_onsets)
+        full = full_results[f"convert_{length}s"]
+        fmin, fmax = converter.pitch_range()
+        results[f"adaptive_{length}s"] = {"sec": sec, "peak_mb": peak, "speedup": full["sec"] / sec,
+                                          "f_measure": f_measure, "f_delta": f_measure - full["f_measure"],
+                                          "fallbacks": converter.range_fallbacks - fallbacks,
+                                          "range_semitones": 12 * np.log2(fmax / fmin)}
+    return results
+
+
+def bench_stream(converter: AudioMidiConverter, raga_map, length, sr, block_size, repeat, speculate=False):
+    """
+    With speculate, the phrase is speculated on before it is finished, as QnADemo does during the silence.
+    The streamed notes must match convert on the same phrase (see AudioMidiConverter.notes_match).
+    """
+    y, (ref_pitches, ref_onsets) = synthesize_phrase(length, raga_map, sr=sr, seed=length)
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch_notes = converter.convert(y)
+
+    def stream():
+        converter.reset_stream()
+        for i in range(0, len(y), block_size):
+            converter.process_block(y[i:i + block_size])
+        if speculate:
+            converter.speculate()
+        start = time.perf_counter()
+        result = converter.finish_stream(return_onsets=True)
+        return result, time.perf_counter() - start
+
+    sec, peak, ((notes, onsets), finish_sec) = measure(stream, repeat=repeat)
+    assert AudioMidiConverter.notes_match(notes, batch_notes), \
+        f"Streamed notes of the {length}s phrase do not match convert ({len(notes)} vs {len(batch_notes)} notes)"
+    name = f"stream_speculative_{length}s" if speculate else f"stream_{length}s"
+    return {name: {"sec": sec, "peak_mb": peak, "finish_sec": finish_sec,
+                   "f_measure": note_accuracy(notes, onsets, ref_pitches, ref_onsets)}}
+
+
+def bench_post(converter: AudioMidiConverter, sizes, repeat):
+    rng = np.random.default_rng(0)
+    results = {}
+    for size in sizes:
+        notes = rng.integers(converter.root - 12, converter.root + 24, size)
+        if converter.raga_map is not None:
+            sec, _, _ = measure(converter.filter_raga, notes, repeat=repeat)
+            results[f"filter_raga_{size}"] = {"sec": sec}
+        sec, _, _ = measure(lambda: converter.fix_outliers(notes.copy(), m=converter.m), repeat=repeat)
+        results[f"fix_outliers_{size}"] = {"sec": sec}
+    return results
+
+
+def bench_callback(qna_params, performer_params, length, repeat):
+    sr, frame_size = qna_params["sr"], qna_params["frame_size"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        performer = Performer(**performer_params)
+        qna = QnADemo(performer=performer, **dict(qna_params, audio_device_cls=NullAudioDevice,
+                                                  transcription_process=False))
+    y, _ = synthesize_phrase(length, qna_params["raga_map"], sr=sr)
+    y = np.concatenate((y, np.zeros((qna_params["n_wait"] + 2) * frame_size, dtype=np.float32)))
+    blocks = [y[i:i + frame_size] for i in range(0, len(y) - frame_size + 1, frame_size)]
+
+    costs = []
+    qna.active = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            qna.reset_var()
+            for block in blocks:
+                start = time.perf_counter()
+                qna.callback_fn(block, frame_size, {}, 0)
+                costs.append(time.perf_counter() - start)
+    qna.active = False
+    performer.engine.stop()
+
+    costs = np.array(costs)
+    return {"callback_fn": {"mean_us": costs.mean() * 1e6, "p99_us": np.percentile(costs, 99) * 1e6,
+                            "max_us": costs.max() * 1e6, "budget_us": frame_size / sr * 1e6}}
+
+
+def bench_filter_phrase(sizes, repeat):
+    rng = np.random.default_rng(0)
+    results = {}
+    for size in sizes:
+        # Chords and close notes included, so both filters of filter_phrase have work to do
+        onsets = np.cumsum(rng.choice([0, 0.02, 0.1, 0.25], size))
+        phrase = Phrase([Note(100, int(p), t, t + 0.1) for p, t in zip(rng.integers(50, 75, size), onsets)],
+                        list(onsets))
+        sec, _, _ = measure(Performer.filter_phrase, phrase, repeat=repeat)
+        results[f"filter_phrase_{size}"] = {"sec": sec, "notes_per_sec": size / sec}
+    return results
+
+
+def print_results(results: dict, baseline: dict = None):
+    for name, values in results.items():
+        line = f"{name:<22}" + "  ".join(f"{k}: {v:.4g}" for k, v in values.items())
+        if baseline and name in baseline:
+            ref = baseline[name]
+            key = "sec" if "sec" in values else "mean_us"
+            if key in ref and values[key] > 0:
+                line += f"  | x{ref[key] / values[key]:.2f} vs baseline"
+        print(line)
+
+
+def run(lengths=(1, 2, 5, 10, 20, 30), repeat: int = 3, out: str = None, baseline: str = None):
+    params = get_params()
+    qna_params = params["qna_param"]
+    raga_map, sr = qna_params["raga_map"], qna_params["sr"]
+    converter_params = {"raga_map": raga_map, "raga_policy": qna_params["raga_policy"], "sr": sr,
+                        "frame_size": qna_params["frame_size"], "outlier_coeff": qna_params["outlier_filter_coeff"]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        converter = AudioMidiConverter(**converter_params)
+
+    results = {}
+    results.update(bench_convert(converter, raga_map, lengths, sr, repeat))
+    results.update(bench_adaptive(converter_params, raga_map, lengths, sr, repeat, results))
+    results.update(bench_stream(converter, raga_map, max(lengths), sr, qna_params["frame_size"], repeat))
+    results.update(bench_stream(converter, raga_map, max(lengths), sr, qna_params["frame_size"], repeat, True))
+    results.update(bench_post(converter, (10, 100, 1000), repeat=max(repeat, 10)))
+    results.update(bench_callback(qna_params, params["performer_param"], 5, repeat))
+    results.update(bench_filter_phrase((10, 100, 1000), repeat=max(repeat, 10)))
+
+    if baseline:
+        with open(baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the audio to MIDI path on synthesized phrases")
+    parser.add_argument("--lengths", type=int, nargs='+', default=[1, 2, 5, 10, 20, 30], help="phrase lengths (sec)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", help="save the results as json")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare with")
+    args = parser.parse_args()
+    run(args.lengths, args.repeat, args.out, args.baseline)
@@ -3,23 +3,31 @@ Author: Raghavasimhan Sankaranarayanan
 Date: 04/08/2022
 """
 import os.path
-from copy import copy
 
 from enum import IntEnum
 import pretty_midi
-from pretty_midi import Note
 import pyaudio
-from pythonosc import udp_client
+from oscSender import OscSender
 from rtmidi.midiconstants import NOTE_OFF, NOTE_ON
 from audioToMidi import AudioMidiConverter
+from transcriber import Transcriber, TranscriptionProcess
 from audioDevice import AudioDevice
 from tempoTracker import TempoTracker
+from audioBeatTracker import AudioBeatTracker
+from responseGenerator import ResponseGenerator
 from gestureController import GestureController
 import numpy as np
 from threading import Thread, Lock, Event
 import time
 import threading
 from queue import Queue
+from collections import deque
+from ringBuffer import RingBuffer
+from scheduler import Scheduler, shared_scheduler
+from phraseCache import PhraseCache, EVENT_DTYPE, ROUTE_ARM, ROUTE_HEAD
+import timing
+from timing import TimingStats
+from tracer import get_tracer
 
 
 class Instruments:
@@ -82,139 +90,175 @@ class Phrase:
         return ret
 
 
+class CompiledPhrase:
+    """
+    A phrase and its gestures as a time-sorted array of OSC events (see phraseCache.EVENT_DTYPE), already filtered
+    """
+    def __init__(self, events: np.ndarray, tempo=None, name=None, ticks=None, last_onset_tick=0):
+        self.events = events
+        self.tempo = tempo
+        self.name = name
+        self.ticks = ticks
+        self.last_onset_tick = last_onset_tick
+        self.is_korvai = name == "korvai"
+        self.is_intro = name == "intro"
+        arm_times = events['time'][events['route'] == ROUTE_ARM]
+        self.arm_end = float(arm_times[-1]) if len(arm_times) > 0 else 0.
+
+    def __len__(self):
+        return len(self.events)
+
+    def meta(self):
+        return {"tempo": self.tempo, "name": self.name, "ticks": self.ticks,
+                "last_onset_tick": float(self.last_onset_tick)}
+
+
 class Performer(GestureController):
     def __init__(self, osc_address: str, osc_port: int, gesture_note_mapping: dict[str, int], osc_arm_route: str = "/arm",
                  osc_head_route: str = "/head", tempo=None, ticks=None, min_note_dist_ms=50,
-                 max_notes_per_onset=4):
-        self.client = udp_client.SimpleUDPClient(osc_address, osc_port)
+                 max_notes_per_onset=4, spin_sec=1e-3, lookahead_sec=0.05, use_osc_bundles=False, bundle_lead_sec=0,
+                 gesture_delay_sec=0.5):
+        self.client = OscSender(osc_address, osc_port, use_bundles=use_osc_bundles)
         super().__init__(self.client, gesture_note_mapping, osc_head_route)
         self.tempo = tempo
         self.osc_arm_route = osc_arm_route
         self.ticks = ticks
         self.min_note_dist_ms = min_note_dist_ms
         self.max_notes_per_onset = max_notes_per_onset
-        self.note_on_thread = Thread()
-        self.note_off_thread = Thread()
-        self.lock = Lock()
-        self.stop_event = threading.Event()
-        self.timer = None
-
-    def perform_gestures(self, gestures: Phrase, tempo=None, wait_for_measure_end=False):
-        self.note_on_thread = Thread(target=self.handle_note_ons, args=(gestures.notes, tempo))
-        self.note_off_thread = Thread(target=self.handle_note_offs, args=(gestures.notes, tempo))
-        if self.timer and self.timer.is_alive():
-            self.timer.join()
-        self.stop_event.set()
-        self.timer = threading.Timer(0.5, self.delay_start_thread)
-        self.timer.start()
-
-    def delay_start_thread(self):
-        if self.note_on_thread.is_alive():
-            self.note_on_thread.join()
-        if self.note_off_thread.is_alive():
-            self.note_off_thread.join()
-        self.stop_event.clear()
-        self.note_on_thread.start()
-        self.note_off_thread.start()
-
-    def handle_note_ons(self, notes: [Note], tempo: int):
-        m = 1
-        if tempo and self.tempo:
-            m = self.tempo / tempo
-
-        prev_start = 0
-        now = time.time()
-        for note in notes:
-            if self.stop_event.is_set():
-                return
-            dly = max(0, ((note.start - prev_start) * m) - (time.time() - now))
-            self.stop_event.wait(dly)
-            # time.sleep(dly)
-            now = time.time()
-            self.lock.acquire()
-            self.send_gesture(note.pitch, note.velocity)
-            self.lock.release()
-            prev_start = note.start
-
-    def handle_note_offs(self, notes: [Note], tempo: int):
-        m = 1
-        if tempo and self.tempo:
-            m = self.tempo / tempo
-
-        prev_end = 0
-        now = time.time()
-        for note in notes:
-            if self.stop_event.is_set():
-                return
-            dly = max(0, ((note.end - prev_end) * m) - (time.time() - now))
-            self.stop_event.wait(dly)
-            now = time.time()
-            self.lock.acquire()
-            self.send_gesture(note.pitch, 0)
-            self.lock.release()
-            prev_end = note.end
-
-    def perform(self, phrase: Phrase, gestures: Phrase or None, tempo=None, wait_for_measure_end=False):
-        phrase = self.filter_phrase(phrase, min_note_dist_ms=self.min_note_dist_ms,
-                                    max_notes_per_onset=self.max_notes_per_onset)
-        notes, onsets = phrase.get()
-        m = 1
-        if self.tempo and tempo:
-            m = self.tempo / tempo
-        i = 0
+        # stop() starts a new generation: a phrase scheduled for an older one is not queued, or stops waiting
+        self.generation = 0
+        self._generation_lock = Lock()
+        # Arm notes, gesture note ons and gesture note offs of every phrase share this single playback thread and clock.
+        # The phrase starts `lookahead_sec` after it is scheduled so that all of its events are queued in time
+        self.engine = Scheduler("Playback", spin_sec=spin_sec)
+        self.lookahead = lookahead_sec
+        self.gesture_delay = gesture_delay_sec  # The gestures start this long after the arm, whatever the tempo
+        # With a lead, every bundle leaves this early with a timetag so that the robot can schedule it exactly
+        self.bundle_lead = bundle_lead_sec if use_osc_bundles else 0
+        self.routes = (osc_arm_route, osc_head_route)  # Indexed by phraseCache.ROUTE_ARM / ROUTE_HEAD
+        self.timing_stats = TimingStats("Phrase")
+        self.last_deadline = 0  # Of the last event of the latest scheduled phrase, gestures included
+        self.tracer = get_tracer()
+
+    def send_gesture(self, gesture, velocity: int):
+        super().send_gesture(gesture, velocity)
+        self.tracer.mark("send_gesture")
+
+    def compile(self, phrase: Phrase, gestures: Phrase or None = None) -> CompiledPhrase:
+        events = []
+        last_onset_tick = 0
+        if len(phrase) > 0:
+            filtered = self.filter_phrase(phrase, min_note_dist_ms=self.min_note_dist_ms,
+                                          max_notes_per_onset=self.max_notes_per_onset)
+            self.tracer.mark("filter_phrase")
+            notes, onsets = filtered.get()
+            # The arm starts with the first note, the gestures follow the timeline of their own file
+            events = [(note.start - notes[0].start, ROUTE_ARM, note.pitch, note.velocity) for note in notes]
+            last_onset_tick = onsets[-1]
 
         if gestures is not None:
-            self.perform_gestures(gestures=gestures, tempo=tempo, wait_for_measure_end=wait_for_measure_end)
-        while i < len(notes):
-            poly_notes = []
-            poly_onsets = []
-            while i < len(onsets):
-                if len(poly_notes) > 0 and poly_onsets[-1] == onsets[i]:
-                    poly_notes.append(notes[i])
-                    poly_onsets.append(onsets[i])
-                    i += 1
-                elif len(poly_notes) == 0 and i < len(notes) - 1 and onsets[i] == onsets[i + 1]:
-                    poly_notes.append(notes[i])
-                    poly_notes.append(notes[i + 1])
-                    poly_onsets.append(onsets[i])
-                    poly_onsets.append(onsets[i + 1])
-                    i += 2
-                else:
-                    break
-
-            duration = 0
-            if len(poly_notes) > 0:
-                if i < len(notes):
-                    duration = notes[i].start - poly_notes[0].start
-                for j in range(len(poly_notes)):
-                    note_on = [int(poly_notes[j].pitch), int(poly_notes[j].velocity)]
-                    self.client.send_message(self.osc_arm_route, note_on)
-            else:
-                if i < len(notes) - 1:
-                    duration = notes[i + 1].start - notes[i].start
-                note_on = [int(notes[i].pitch), int(notes[i].velocity)]
-                self.client.send_message(self.osc_arm_route, note_on)
-                i += 1
-
-            time.sleep(duration * m)
+            for note in gestures.notes:
+                events.append((note.start, ROUTE_HEAD, note.pitch, note.velocity))
+                events.append((note.end, ROUTE_HEAD, note.pitch, 0))
+
+        events = np.array(events, dtype=EVENT_DTYPE)
+        events = events[np.argsort(events['time'], kind='stable')]
+        return CompiledPhrase(events, tempo=phrase.tempo, name=phrase.name, ticks=self.ticks,
+                              last_onset_tick=last_onset_tick)
+
+    def _send_events(self, events: np.ndarray, deadline, stats, trace_id=0):
+        timetag = None
+        if self.bundle_lead > 0:
+            timetag = time.time() + self.bundle_lead - (timing.now() - deadline)
+        self.client.send_messages([(self.routes[route], [pitch, velocity]) for _, route, pitch, velocity in events.tolist()],
+                                  timetag=timetag)
+        self.tracer.mark("send", trace_id)
+        stats.add(deadline)
+
+    def get_time_scale(self, tempo, reference_tempo=None):
+        reference_tempo = reference_tempo or self.tempo
+        if tempo and reference_tempo:
+            return reference_tempo / tempo
+        return 1
+
+    def perform(self, phrase: Phrase, gestures: Phrase or None, tempo=None, wait_for_measure_end=False,
+                generation=None) -> bool:
+        return self.play(self.compile(phrase, gestures), tempo=tempo, wait_for_measure_end=wait_for_measure_end,
+                         generation=generation)
+
+    def play(self, phrase: CompiledPhrase, tempo=None, wait_for_measure_end=False, generation=None) -> bool:
+        """
+        Returns False if the performer was stopped before the end of the phrase
+        """
+        generation = self.generation if generation is None else generation
+        end = self.schedule(phrase, tempo=tempo, wait_for_measure_end=wait_for_measure_end, generation=generation)
+        if end is None:
+            return False
+
+        # The gestures may outlast the phrase, only the arm part is waited for
+        done = Event()
+        self.engine.call_at(end, done.set)
+        while not done.wait(0.05):
+            if self.generation != generation:
+                return False
+        print(self.timing_stats)
+        return True
+
+    def schedule(self, phrase: CompiledPhrase, tempo=None, start=None, wait_for_measure_end=False,
+                 generation=None) -> float or None:
+        """
+        Queue all the events of the phrase on the playback engine, starting at `start` (timing.now() clock).
+        Returns the time at which the phrase ends (the end of the bar if wait_for_measure_end), without waiting.
+        Nothing is queued and None is returned if the performer was stopped since `generation` (see stop).
+        """
+        with self._generation_lock:  # A stop() either comes before and is seen, or after and clears the events
+            if generation is not None and generation != self.generation:
+                return None
+            return self._schedule(phrase, tempo, start, wait_for_measure_end)
+
+    def _schedule(self, phrase: CompiledPhrase, tempo, start, wait_for_measure_end) -> float:
+        events = phrase.events
+        m = self.get_time_scale(tempo, phrase.tempo)
+
+        # Every event has an absolute deadline from the phrase start, so send and sleep overheads never accumulate.
+        # Events sharing a time are sent by a single callback
+        if start is None:
+            start = timing.now() + self.lookahead
+        self.timing_stats = TimingStats(phrase.name or "Phrase")
+        trace_id = self.tracer.current_trace()  # The sends run on the playback thread
+        deadlines = start + events['time'] * m - self.bundle_lead
+        deadlines[events['route'] == ROUTE_HEAD] += self.gesture_delay
+        order = np.argsort(deadlines, kind='stable')
+        events, deadlines = events[order], deadlines[order]
+        bounds = np.flatnonzero(np.diff(deadlines)) + 1
+        for group, group_deadlines in zip(np.split(events, bounds), np.split(deadlines, bounds)):
+            if len(group) == 0:
+                continue
+            deadline = float(group_deadlines[0])
+            self.engine.call_at(deadline, self._send_events, group, deadline, self.timing_stats, trace_id)
+        if len(deadlines) > 0:
+            self.last_deadline = float(deadlines[-1])
 
-        if wait_for_measure_end and tempo and self.ticks:
-            self.wait_for_measure_end(onsets, tempo)
+        end = start + phrase.arm_end * m
+        if wait_for_measure_end and tempo and (phrase.ticks or self.ticks):
+            end += self.get_measure_end_delay(phrase.last_onset_tick, tempo, phrase.ticks or self.ticks)
+        return end
 
-        # if gestures is not None:
-        #     self.note_on_thread.join(0.1)
-        #     self.note_off_thread.join(0.1)
+    def stop(self):
+        with self._generation_lock:
+            self.generation += 1
+            self.engine.clear()
 
-    def wait_for_measure_end(self, onsets, tempo):
+    @staticmethod
+    def get_measure_end_delay(last_onset_tick, tempo, ticks):
         # Assume 4/4
-        bar_tick = self.ticks * 4
+        bar_tick = ticks * 4
         # measure_tick = bar_tick * 4
-        while bar_tick < onsets[-1]:
+        while bar_tick < last_onset_tick:
             bar_tick += bar_tick
-        remaining_ticks = bar_tick - onsets[-1]
-        print(remaining_ticks, bar_tick, onsets[-1])
-        if remaining_ticks > 0:
-            time.sleep(remaining_ticks * 60 / (tempo * self.ticks))
+        remaining_ticks = bar_tick - last_onset_tick
+        print(remaining_ticks, bar_tick, last_onset_tick)
+        return max(0, remaining_ticks * 60 / (tempo * ticks))
 
     @staticmethod
     def filter_phrase(phrase: Phrase, min_note_dist_ms: float = 50, max_notes_per_onset: int = 4):
@@ -247,97 +291,157 @@ class Demo:
 class QnADemo(Demo):
     def __init__(self, performer: Performer, raga_map, sr=16000,
                  instruments=("Violin", "Keys"), frame_size=2048, activation_threshold=0.02, n_wait=16,
-                 input_dev_name='Line 6 HX Stomp', outlier_filter_coeff=2, timeout_sec=2):
+                 input_dev_name='Line 6 HX Stomp', outlier_filter_coeff=2, timeout_sec=2, streaming=True,
+                 max_phrase_sec=30, channels=4, channel_map=2, stream_interval_sec=0.1, audio_device_cls=AudioDevice,
+                 transcription_process=True, raga_policy="snap", adaptive_pitch_range=False,
+                 response_midi_files: [str] = None, response_temperature: float = 1.0, speculative=True,
+                 speculate_after_blocks=1):
         super().__init__()
         self.active = False
+        self.streaming = streaming
         self.activation_threshold = activation_threshold
         self.n_wait = n_wait
         self.wait_count = 0
         self.playing = False
-        self.phrase = []
+
+        # The audio callback writes the violin into the ring buffer and publishes finished phrases as (start, end,
+        # trace id) with sample positions. Twice the longest phrase so that the next phrase can be captured while one is transcribed.
+        self.max_phrase_len = int(max_phrase_sec * sr)
+        self.ring = RingBuffer(2 * self.max_phrase_len, shared=transcription_process)
+        self.phrase_start = 0
+        self.phrases = deque()
+        self.phrase_event = Event()  # Set as soon as a violin or a keyboard phrase is published
+        self.key_phrases = deque()
+        self.stream_interval = stream_interval_sec
+        self._stream_start = None
+        self._n_fed = 0
+        # Phrases end at their last loud block. Once the player has been silent for `speculate_after_blocks`, the phrase
+        # so far is transcribed ahead, and the end of the phrase only has the notes left to do if nothing was played since
+        self._sound_end = 0
+        self.speculative = speculative and streaming
+        self.speculate_after = speculate_after_blocks
+        self._speculated = None
+        self._abs_frame = np.zeros(frame_size, dtype=np.float32)
+        # Each phrase is traced from its last note to its last OSC message
+        self.tracer = get_tracer()
+        self._trace_id = 0
+        self._last_note_time = 0
+
         self.midi_notes = []
         self.midi_onsets = []
+        # Answers to the keyboard are variations drawn from a model of the phrase library
+        self.response_generator = ResponseGenerator(raga_map, midi_files=response_midi_files)
+        self.response_temperature = response_temperature
 
         self.process_thread = Thread()
-        self.event = Event()
+        self.scheduler = shared_scheduler()
+        self._timeout_handle = None  # End of the keyboard phrase, moved to `timeout_sec` after every note-on
+        self._key_deadline = None
+        self._keys_lock = Lock()
         self.lock = Lock()
 
         try:
-            self.audioDevice = AudioDevice(self.callback_fn, rate=sr, frame_size=frame_size,
-                                           input_dev_name=input_dev_name,
-                                           channels=4)
+            self.audioDevice = audio_device_cls(self.callback_fn, rate=sr, frame_size=frame_size,
+                                                input_dev_name=input_dev_name,
+                                                channels=channels, channel_map=channel_map)
         except AssertionError:
             print(f"{input_dev_name} not found. Disabling violin input for QnA Demo")
             self.audioDevice = None
 
-        self.audio2midi = AudioMidiConverter(raga_map=raga_map, sr=sr, frame_size=frame_size,
-                                             outlier_coeff=outlier_filter_coeff)
+        # Transcription runs in its own process by default, reading the phrases straight from the shared ring buffer
+        converter_params = {"raga_map": raga_map, "raga_policy": raga_policy, "sr": sr, "frame_size": frame_size,
+                            "outlier_coeff": outlier_filter_coeff, "adaptive_range": adaptive_pitch_range}
+        if transcription_process:
+            self.transcriber = TranscriptionProcess(self.ring, converter_params)
+        else:
+            self.transcriber = Transcriber(self.ring, converter_params)
         if self.audioDevice:
             self.audioDevice.start()
 
         self.instruments = Instruments(instruments) if self.audioDevice else Instruments(["Keys"])
         self.timeout = timeout_sec
-        self.last_time = time.time()
+        self.last_time = timing.now()  # Keyboard notes are on the clock of the MIDI timestamps
         self.performer = performer
 
     def reset_var(self):
         self.wait_count = 0
         self.playing = False
-        self.phrase = []
-        self.last_time = time.time()
+        self.phrase_start = self.ring.count  # Drops the phrase being captured, if any
+        self.last_time = timing.now()
 
-    def handle_midi(self, msg, dt):
+    def handle_midi(self, msg, timestamp):
         if self.instruments.current() != self.instruments.keyboard:
             print(f"Its {self.instruments.current()}'s turn")
             return
 
         if msg[0] == NOTE_ON:
-            self.last_time = time.time()
-            note = pretty_midi.Note(msg[2], msg[1], self.last_time, self.last_time + 0.1)
-            self.midi_notes.append(note)
-            self.midi_onsets.append(self.last_time)
-
-    def callback_fn(self, in_data: bytes, frame_count: int, time_info: dict[str, float], status: int) -> tuple[
-        bytes, int]:
+            with self._keys_lock:
+                self.last_time = timestamp
+                note = pretty_midi.Note(msg[2], msg[1], self.last_time, self.last_time + 0.1)
+                self.midi_notes.append(note)
+                self.midi_onsets.append(self.last_time)
+                if self._timeout_handle:
+                    self._timeout_handle.cancel()
+                self._key_deadline = timestamp + self.timeout
+                self._timeout_handle = self.scheduler.call_at(self._key_deadline, self.end_key_phrase,
+                                                              self._key_deadline)
+
+    def callback_fn(self, y: np.ndarray, frame_count: int, time_info: dict[str, float], status: int) -> int:
         if not self.active:
             self.reset_var()
-            return in_data, pyaudio.paContinue
+            return pyaudio.paContinue
 
-        y = np.frombuffer(in_data, dtype=np.int16)
-        y = y[::2][1::2]  # Get all the even indices then get all odd indices for ch-3 of HX Stomp
-        y = self.int16_to_float(y)
-        activation = np.abs(y).mean()
+        self.tracer.mark("callback", self._trace_id)
+        if len(y) > len(self._abs_frame):
+            self._abs_frame = np.zeros(len(y), dtype=np.float32)
+        activation = np.abs(y, out=self._abs_frame[:len(y)]).mean()
         if activation > self.activation_threshold:
             print(activation)
             if self.instruments.current() != self.instruments.violin:
                 print(f"Its {self.instruments.current()}'s turn")
                 self.reset_var()
-                return in_data, pyaudio.paContinue
+                return pyaudio.paContinue
+            if not self.playing:
+                self.phrase_start = self.ring.count
+                self._trace_id = self.tracer.new_trace()
             self.playing = True
             self.wait_count = 0
-            self.lock.acquire()
-            self.phrase.append(y)
-            self.lock.release()
+            self._last_note_time = timing.now()
+            self._capture(y)
+            self._sound_end = self.ring.count
         else:
             if self.wait_count > self.n_wait:
+                if self.playing:
+                    self._publish_phrase(self._sound_end)
                 self.playing = False
                 self.wait_count = 0
             else:
-                self.lock.acquire()
                 if self.playing:
-                    self.phrase.append(y)
-                self.lock.release()
+                    self._capture(y)
                 self.wait_count += 1
-        return in_data, pyaudio.paContinue
+        return pyaudio.paContinue
+
+    def _capture(self, y):
+        self.ring.write(y)
+        if self.ring.count - self.phrase_start >= self.max_phrase_len:
+            # Longest phrase reached, hand it over and keep capturing into a new one
+            self._publish_phrase(self.ring.count)
+            self.phrase_start = self.ring.count
+            self._trace_id = self.tracer.new_trace()
+
+    def _publish_phrase(self, end):
+        self.tracer.mark("last_note", self._trace_id, t=self._last_note_time)
+        self.tracer.mark("phrase_end", self._trace_id)
+        self.phrases.append((self.phrase_start, end, self._trace_id))
+        self.phrase_event.set()
+        self._trace_id = 0
 
     def reset(self):
         self.stop()
         if self.audioDevice:
             self.audioDevice.reset()
-
-    @staticmethod
-    def int16_to_float(x):
-        return x / (1 << 15)
+        self.transcriber.close()
+        self.ring.close()
 
     # @staticmethod
     # def to_float(x):
@@ -351,6 +455,9 @@ class QnADemo(Demo):
 
     def start(self):
         self.reset_var()
+        self.phrases.clear()
+        self.key_phrases.clear()
+        self.phrase_event.clear()
         if self.process_thread.is_alive():
             self.process_thread.join()
         self.lock.acquire()
@@ -358,164 +465,290 @@ class QnADemo(Demo):
         self.lock.release()
         self.process_thread = Thread(target=self._process)
         self.process_thread.start()
-        self.event.clear()
-        self.check_timeout()
 
     def _process(self):
-        while True:
-            time.sleep(0.1)
-            self.lock.acquire()
+        self._stream_start = None
+        self._n_fed = 0
+        self._speculated = None
+        while self.active:
+            # Wakes up as soon as the audio callback publishes a phrase, and every stream_interval to track the pitch
+            # of the phrase being played
+            self.phrase_event.wait(self.stream_interval if self.streaming else None)
+            # Cleared before the queues are read: a phrase published after this sets it again, and one drained by the
+            # loops below leaves no stale event behind
+            self.phrase_event.clear()
             if not self.active:
-                self.lock.release()
                 return
 
-            if not (self.playing or len(self.phrase) == 0):
-                self.lock.release()
-                break
-            self.lock.release()
-
-        self.lock.acquire()
-        phrase = np.hstack(self.phrase)
-        self.phrase = []
-        self.lock.release()
-
-        if len(phrase) > 0:
-            notes, onsets = self.audio2midi.convert(phrase, return_onsets=True)
-            print("notes:", notes)  # Send to shimon
-            print("onsets:", onsets)
-            phrase = Phrase(notes, onsets)
-            self.perform(phrase)
+            if not (self.phrases or self.key_phrases):
+                if self.streaming and self.playing:
+                    self._feed_stream()
+                    if self.speculative and self.wait_count >= self.speculate_after and self._n_fed != self._speculated:
+                        self.transcriber.speculate()
+                        self._speculated = self._n_fed
+                continue
 
-        self._process()
+            while self.key_phrases and self.active:
+                phrase, trace_id = self.key_phrases.popleft()
+                self._begin_trace(trace_id)
+                phrase = self.process_midi_phrase(phrase, self.response_temperature)
+                if not self.perform(phrase):
+                    break
+                print(self.tracer.summary(trace_id))
+
+            while self.phrases and self.active:
+                start, end, trace_id = self.phrases.popleft()
+                if end > start:
+                    self._begin_trace(trace_id)
+                    try:
+                        notes, onsets = self._transcribe(start, end)
+                    except (RuntimeError, ValueError) as e:  # Phrase overwritten in the ring or transcription failed
+                        print(f"Warning: dropping phrase: {e}")
+                        continue
+                    print("notes:", notes)  # Send to shimon
+                    print("onsets:", onsets)
+                    if not self.perform(Phrase(AudioMidiConverter.to_note_list(notes), onsets)):
+                        break
+                    print(self.tracer.summary(trace_id))
+            self.tracer.set_trace(0)
+
+    def _begin_trace(self, trace_id):
+        self.tracer.set_trace(trace_id)
+        self.tracer.mark("dequeued")
+
+    def _feed_stream(self):
+        # Read the end before the phrase start: a phrase published in between is then never fed past its end
+        count = self._sound_end
+        start = self.phrase_start
+        if start != self._stream_start:  # A new phrase, or the previous one was dropped by the audio callback
+            self.transcriber.reset_stream()
+            self._stream_start, self._n_fed = start, start
+        if count > self._n_fed:
+            self.transcriber.process_block(self._n_fed, count)
+            self._n_fed = count
+
+    def _transcribe(self, start, end):
+        if not self.streaming:
+            return self.transcriber.convert(start, end)
+
+        if start != self._stream_start:
+            self.transcriber.reset_stream()
+            self._n_fed = start
+        if end > self._n_fed:
+            self.transcriber.process_block(self._n_fed, end)
+        self._stream_start = None
+        return self.transcriber.finish_stream()
 
     def stop(self):
         self.lock.acquire()
         self.active = False
         self.lock.release()
+        self.phrase_event.set()
+        self.performer.stop()  # Drops the phrase being performed, and any the worker is about to perform
         if self.process_thread.is_alive():
             self.process_thread.join()
         if self.audioDevice:
             self.audioDevice.stop()
-        self.event.set()
-
-    def perform(self, phrase):
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+
+    def perform(self, phrase) -> bool:
+        """
+        Returns False, without performing, once the demo is stopped
+        """
+        # The generation is taken while the demo is known to be active: a stop() from here on stops the phrase
+        with self.lock:
+            if not self.active:
+                return False
+            generation = self.performer.generation
         self.performer.send_gesture(gesture="look", velocity=3)  # Look straight
         self.performer.send_gesture(gesture="headcircle", velocity=80)
         # threading.Timer(0.5, self.gesture_controller.send, kwargs={"gesture": "headcircle", "velocity": 80}).start()
         # time.sleep(0.5)     # Shimon hardware wait simulation
-        self.performer.perform(phrase=phrase, gestures=None)
+        if not self.performer.perform(phrase=phrase, gestures=None, generation=generation):
+            return False
         self.performer.send_gesture(gesture="headcircle", velocity=0)
         self.performer.send_gesture(gesture="look",
                                     velocity=next(self.instruments) + 1)  # Look at the respective artist
+        return True
 
-    @staticmethod
-    def process_midi_phrase(phrase, temperature: float = 1.0):
-        temperature = max(min(temperature, 1), 0)
-        n_notes_to_change = np.random.randint(0, int((len(phrase)) * temperature), 1)
-        w = np.hanning(len(phrase)) + 1e-6  # to avoid ValueError: Fewer non-zero entries in p than size
-        p = w / np.sum(w)
-        indices = np.random.choice(np.arange(len(phrase)), n_notes_to_change, replace=False, p=p)
-        options = np.unique(phrase.get_raw_notes())
-        for i in indices:
-            phrase.notes[i].pitch = np.random.choice(options, 1)[0]
+    def process_midi_phrase(self, phrase, temperature: float = 1.0):
+        pitches = self.response_generator.respond(phrase.get_raw_notes(), temperature)
+        for note, pitch in zip(phrase.notes, pitches.tolist()):
+            note.pitch = pitch
         return phrase
 
-    def check_timeout(self):
-        if time.time() - self.last_time > self.timeout and len(self.midi_notes) > 0:
-            midi_notes = copy(self.midi_notes)
-            midi_onsets = copy(self.midi_onsets)
+    def end_key_phrase(self, deadline):
+        """
+        Runs on the scheduler `timeout_sec` after the last keyboard note-on
+        """
+        with self._keys_lock:
+            if deadline != self._key_deadline or len(self.midi_notes) == 0:
+                return  # Re-armed by a note that came in while this call was due
+            midi_notes = self.midi_notes
+            midi_onsets = self.midi_onsets
             self.midi_notes = []
             self.midi_onsets = []
-            t = midi_notes[0].start
-            for i in range(len(midi_notes)):
-                midi_notes[i].start -= t
-                midi_notes[i].end -= t
-                midi_onsets[i] -= t
+            self._timeout_handle = None
+        if not self.active:
+            return
 
-            phrase = Phrase(midi_notes, midi_onsets)
-            phrase = self.process_midi_phrase(phrase)
-            self.perform(phrase)
+        t = midi_notes[0].start
+        for i in range(len(midi_notes)):
+            midi_notes[i].start -= t
+            midi_notes[i].end -= t
+            midi_onsets[i] -= t
 
-        if not self.event.is_set():
-            threading.Timer(1, self.check_timeout).start()
+        # Performing takes the length of the phrase, hand it over to the worker thread
+        trace_id = self.tracer.new_trace()
+        self.tracer.mark("last_note", trace_id, t=deadline - self.timeout)
+        self.tracer.mark("phrase_end", trace_id)
+        self.key_phrases.append((Phrase(midi_notes, midi_onsets), trace_id))
+        self.phrase_event.set()
 
 
 class BeatDetectionDemo(Demo):
     def __init__(self, performer: Performer, tempo_range: tuple = (60, 120), smoothing=4, n_beats_to_track=16,
-                 timeout_sec=5, timeout_callback=None, user_data=None, default_tempo: int = 80):
+                 timeout_sec=5, timeout_callback=None, user_data=None, default_tempo: int = 80, scheduler=None,
+                 latency_compensation_sec: float = 0, min_confidence: float = 0.5, source: str = "midi",
+                 audio_device: AudioDevice = None):
+        """
+        source: "midi" tracks the keyboard's note-ons, "audio" the beats of `audio_device`'s stream, "both" both of them
+        """
         super().__init__()
         self.performer = performer
+        self.min_confidence = min_confidence
         self.timeout_callback = timeout_callback
         self.user_data = user_data
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
         self.tempo_tracker = TempoTracker(smoothing=smoothing, n_beats_to_track=n_beats_to_track,
                                           tempo_range=tempo_range, default_tempo=default_tempo,
-                                          timeout_sec=timeout_sec, timeout_callback=self.timeout_handle)
-        self._event = threading.Event()
-        self._first_time = True
+                                          timeout_sec=timeout_sec, timeout_callback=self.timeout_handle,
+                                          scheduler=self.scheduler)
+        # The head bang is sent this long before the predicted beat to make up for the robot's mechanical delay
+        self.latency = latency_compensation_sec
+        self._gesture_handle = None
+        self._gesture_lock = Lock()  # schedule_beat runs from the MIDI callback or the audio tracker and the scheduler
+        self.active = False  # No head bang is armed once stopped, even by a callback already running
+        self._last_beat = None
         self._last_time = time.time()
         self._beat_interval = -1
 
+        self.source = source
+        self.audio_device = audio_device
+        self.audio_tracker = None
+        if source != "midi":
+            if audio_device is None:
+                print("No audio input. Beat detection falls back to MIDI")
+                self.source = "midi"
+            else:
+                self.audio_tracker = AudioBeatTracker(self.handle_beat, sr=audio_device.rate)
+
     def start(self):
-        self._first_time = True
+        self._last_beat = None
+        with self._gesture_lock:
+            self.active = True
         self.performer.send_gesture("look", 8)  # look at the keyboard artist
         self.tempo_tracker.start()
-        self._event.clear()
+        if self.audio_tracker:
+            self.audio_tracker.start()
+            self.audio_device.add_listener(self.audio_tracker.feed)
+            self.audio_device.start()
 
     def stop(self):
         self.tempo_tracker.stop()
-        self._event.set()
-        self._first_time = True
+        if self.audio_tracker:
+            self.audio_device.remove_listener(self.audio_tracker.feed)  # The device belongs to QnADemo
+            self.audio_tracker.stop()
+        with self._gesture_lock:
+            self.active = False
+            if self._gesture_handle:
+                self._gesture_handle.cancel()
+                self._gesture_handle = None
 
     def reset(self):
         self.stop()
 
-    def handle_midi(self, msg, dt):
-        self.update_tempo(msg, dt)
+    def handle_midi(self, msg, timestamp):
+        if self.source != "audio":
+            self.update_tempo(msg, timestamp)
 
-    def update_tempo(self, msg, dt):
+    def handle_beat(self, timestamp):
+        # Beats from the audio tracker count as note-ons on the beat
+        self._track(None, timestamp)
+
+    def update_tempo(self, msg, timestamp):
         if msg[0] == NOTE_ON:
-            tempo = self.tempo_tracker.track_tempo(msg, dt)
-            if tempo:
-                print(tempo)
-                self.set_beat_interval(tempo)
-                if self._first_time:
-                    self.gesture_ctl()
-                    self._first_time = False
+            self._track(msg, timestamp)
+
+    def _track(self, msg, timestamp):
+        tempo = self.tempo_tracker.track_tempo(msg, timestamp)
+        if tempo:
+            print(tempo)
+            self.set_beat_interval(tempo)
+            self.schedule_beat()
 
     def set_beat_interval(self, tempo: float):
         self._beat_interval = 60 / tempo
 
+    def schedule_beat(self):
+        # (Re)aim the next head bang at the latest prediction, every note-on refines the phase and period
+        if not self.active:
+            return
+        predictor = self.tempo_tracker.beat_predictor
+        earliest = timing.now() + self.latency
+        if self._last_beat is not None and predictor.period:
+            earliest = max(earliest, self._last_beat + predictor.period / 2)  # Never twice for the same beat
+        beat = predictor.next_beat(earliest)
+        if beat is None:
+            return
+        with self._gesture_lock:
+            if not self.active:
+                return
+            if self._gesture_handle:
+                self._gesture_handle.cancel()
+            self._gesture_handle = self.scheduler.call_at(beat - self.latency, self._on_beat, beat)
+
+    def _on_beat(self, beat):
+        if not self.active:
+            return
+        self.gesture_ctl()
+        self._last_beat = beat
+        self.schedule_beat()
+
     def get_tempo(self):
-        return self.tempo_tracker.tempo
+        return self.tempo_tracker.tempo, self.tempo_tracker.confidence
 
     def timeout_handle(self):
         self.timeout_callback(self.user_data)
 
     def gesture_ctl(self):
         self.performer.send_gesture("beatOnce", 80)
-        if not self._event.is_set():
-            threading.Timer(self._beat_interval, self.gesture_ctl).start()
 
 
 class SongDemo(Demo):
     def __init__(self, performer: Performer, midi_files: [[str]], gesture_midi_files: [[str]],
-                 start_note_for_phrase_mapping: int = 36, complete_callback=None, user_data=None):
+                 start_note_for_phrase_mapping: int = 36, complete_callback=None, user_data=None,
+                 cache_dir: str = ".phrase_cache", prepare_sec: float = 0.2):
         super().__init__()
         self.performer = performer
         self.phrase_note_map = start_note_for_phrase_mapping
         self.user_data = user_data
         self.phrase_idx = 0
         self.variation_idx = 0
-        self.phrases = self._parse_midi(midi_files)
-        self.g_phrases = self._parse_midi(gesture_midi_files)
+        self.ticks = 480
+        self.cache = PhraseCache(cache_dir)
+        self.phrases = self._load_phrases(midi_files, gesture_midi_files)  # Phrases compiled with their gestures
         self.file_tempo = self.phrases[self.phrase_idx][self.variation_idx].tempo
         self.next_phrase = self.phrases[self.phrase_idx][self.variation_idx]  # intro phrase
-        self.next_g_phrase = self.g_phrases[self.phrase_idx][self.variation_idx]  # intro gesture
-        self.ticks = 480
         self.tempo = self.file_tempo
         self.playing = False
+        self.prepare_sec = prepare_sec  # The next phrase is chosen and queued this long before the bar boundary
+        self.stop_event = Event()
         self.thread = Thread()
         self.lock = Lock()
+        self.scheduler = shared_scheduler()
         self.callback_queue = Queue(1)
         self.callback_queue.put(complete_callback)
 
@@ -527,16 +760,21 @@ class SongDemo(Demo):
 
     def start(self):
         self.playing = True
+        self.stop_event.clear()
         self.performer.send_gesture("look", 8)  # look at the keyboard artist
-        self.thread = Thread(target=self.perform, args=(self.next_phrase, self.next_g_phrase))
+        self.thread = Thread(target=self.perform, args=(self.next_phrase,))
         self.thread.start()
 
     def stop(self):
         self.lock.acquire()
         self.playing = False
         self.lock.release()
+        self.stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.performer.stop()  # The phrase queued on the playback engine stops with the demo
 
-    def handle_midi(self, msg, dt):
+    def handle_midi(self, msg, timestamp):
         if msg[0] == NOTE_ON:
             # print(msg)
             idx = msg[1] - self.phrase_note_map
@@ -549,55 +787,86 @@ class SongDemo(Demo):
         if len(self.phrases) > idx >= 0:
             self.variation_idx = 0 if reset_variation else (self.variation_idx + 1) % len(self.phrases[idx])
             self.next_phrase = self.phrases[idx][self.variation_idx]
-            self.next_g_phrase = self.g_phrases[idx][self.variation_idx]
             print(self.next_phrase.name)
 
-    def perform(self, phrase: Phrase or None, gestures: Phrase or None):
-        if phrase.is_korvai:
-            self.next_phrase = None
-            self.next_g_phrase = None
-
-        if phrase.is_intro and len(self.phrases) > 1:
-            self.phrase_idx = 1
+    def perform(self, phrase: CompiledPhrase or None):
+        # Each phrase is queued to start exactly at the bar boundary where the previous one ends. The next one is chosen
+        # `prepare_sec` before that boundary while the current one is still playing, so there is no gap between them
+        generation = self.performer.generation
+        start = timing.now() + self.performer.lookahead
+        while phrase is not None and self.playing:
+            if phrase.is_korvai:
+                self.next_phrase = None
+
+            if phrase.is_intro and len(self.phrases) > 1:
+                self.phrase_idx = 1
+
+            end = self.performer.schedule(phrase, self.tempo, start=start, wait_for_measure_end=True,
+                                          generation=generation)
+            if end is None:
+                return
+            # Reported once the last event of the phrase is sent, after the next phrase is queued
+            self.scheduler.call_at(self.performer.last_deadline, print, self.performer.timing_stats)
+            if not timing.sleep_until(end - self.prepare_sec, spin_sec=0, stop_event=self.stop_event):
+                return
 
-        self.performer.perform(phrase, gestures, self.tempo, wait_for_measure_end=True)
+            phrase = None
+            if self.next_phrase:
+                self.set_phrase()  # Calling this here will cycle variation
+                phrase = self.next_phrase
+            start = end
 
-        if self.next_phrase and self.next_g_phrase:
-            self.set_phrase()  # Calling this here will cycle variation
-            self.perform(phrase=self.next_phrase, gestures=self.next_g_phrase)
+        # Let the last phrase ring until its end
+        timing.sleep_until(start, spin_sec=0, stop_event=self.stop_event)
 
     def wait(self):
         if self.thread.is_alive():
             self.thread.join()
 
-    def _parse_midi(self, midi_files):
+    def _load_phrases(self, midi_files: [[str]], gesture_midi_files: [[str]] or None):
         if not midi_files:
             return None
 
-        # Func to use as key for the sort method
-        def note_sort(_note):
-            return _note.start
-
+        params = {"min_note_dist_ms": self.performer.min_note_dist_ms,
+                  "max_notes_per_onset": self.performer.max_notes_per_onset}
         phrases = []
-
-        for variations in midi_files:
+        for i, variations in enumerate(midi_files):
             temp = []
-            for midi_file in variations:
-                name = os.path.splitext(os.path.split(midi_file)[-1])[0]
-                midi_data = pretty_midi.PrettyMIDI(midi_file)
-                self.ticks = midi_data.resolution
-                notes = sorted(midi_data.instruments[0].notes, key=note_sort)
-                onsets = []
-                for note in notes:
-                    onsets.append(midi_data.time_to_tick(note.start))
-                # print(name)
-                # print(notes)
-                # print(onsets)
-                # print()
-                temp.append(Phrase(notes, onsets, round(midi_data.get_tempo_changes()[1][0], 3), name))
+            for j, midi_file in enumerate(variations):
+                gesture_file = gesture_midi_files[i][j] if gesture_midi_files else None
+                key = self.cache.key([midi_file, gesture_file], params)
+                events, meta = self.cache.load(key)
+                if events is None:
+                    phrase, self.ticks = self._parse_midi(midi_file)
+                    gestures = self._parse_midi(gesture_file)[0] if gesture_file else None
+                    compiled = self.performer.compile(phrase, gestures)
+                    compiled.ticks = self.ticks
+                    self.cache.save(key, compiled.events, compiled.meta())
+                else:
+                    compiled = CompiledPhrase(events, **meta)
+                    self.ticks = compiled.ticks
+                temp.append(compiled)
             phrases.append(temp)
         return phrases
 
+    @staticmethod
+    def _parse_midi(midi_file):
+        # Func to use as key for the sort method
+        def note_sort(_note):
+            return _note.start
+
+        name = os.path.splitext(os.path.split(midi_file)[-1])[0]
+        midi_data = pretty_midi.PrettyMIDI(midi_file)
+        notes = sorted(midi_data.instruments[0].notes, key=note_sort)
+        onsets = []
+        for note in notes:
+            onsets.append(midi_data.time_to_tick(note.start))
+        # print(name)
+        # print(notes)
+        # print(onsets)
+        # print()
+        return Phrase(notes, onsets, round(midi_data.get_tempo_changes()[1][0], 3), name), midi_data.resolution
+
     def reset(self):
         self.stop()
         self.wait()
@@ -4,18 +4,24 @@ Date: 04/08/2022
 """
 from midiDevice import MidiInDevice
 from rtmidi.midiconstants import NOTE_ON
+from threading import Thread, current_thread
 import time
 from demos import Performer, Demo, BeatDetectionDemo, QnADemo, SongDemo
 
 
 class ShimonDemo:
-    def __init__(self, keyboard_name, mode_key, qna_param, bd_param, song_param, performer_param):
+    def __init__(self, keyboard_name, mode_key, qna_param, bd_param, song_param, performer_param,
+                 midi_device_cls=MidiInDevice):
         self.mode_key = mode_key
         self.performer = Performer(ticks=480, **performer_param)
         self.qna_demo = QnADemo(performer=self.performer, **qna_param)
 
-        self.keys = MidiInDevice(keyboard_name, callback_fn=self.keys_callback)
-        self.bd_demo = BeatDetectionDemo(performer=self.performer, timeout_callback=self.bd_timeout_callback, **bd_param)
+        # The keyboard messages are queued by the MIDI callback and handled in batches by the keys thread, so the demos'
+        # work never delays the MIDI callback. The timestamps are those of the messages' arrival
+        self.keys = midi_device_cls(keyboard_name)
+        self.keys_thread = Thread()
+        self.bd_demo = BeatDetectionDemo(performer=self.performer, timeout_callback=self.bd_timeout_callback,
+                                         audio_device=self.qna_demo.audioDevice, **bd_param)
         self.song_demo = SongDemo(performer=self.performer, complete_callback=self.song_complete_callback, **song_param)
         self.running = False
         self.current_demo = self.qna_demo
@@ -26,12 +32,23 @@ class ShimonDemo:
     def set_current_demo(self, current_demo: Demo):
         self.current_demo = current_demo
 
-    def keys_callback(self, msg, dt, user_data):
+    def keys_callback(self, msg, timestamp, user_data):
         if msg[0] == NOTE_ON:
             if msg[1] == self.mode_key and self.current_demo != self.song_demo:
                 self.manage_demos()
             else:
-                self.current_demo.handle_midi(msg, dt)
+                self.current_demo.handle_midi(msg, timestamp)
+
+    def start_keys(self):
+        if not self.keys_thread.is_alive():
+            self.keys_thread = Thread(target=self._dispatch_keys, name="Keys", daemon=True)
+            self.keys_thread.start()
+
+    def _dispatch_keys(self):
+        while self.running:
+            if self.keys.wait(0.1):
+                for msg, timestamp in self.keys.drain():
+                    self.keys_callback(msg, timestamp, None)
 
     def song_complete_callback(self, user_data):  # Not Implemented
         self.stop()
@@ -43,14 +60,17 @@ class ShimonDemo:
             print("Beat detection demo")
         elif self.current_demo == self.bd_demo:
             print("Song demo")
-            tempo = self.bd_demo.get_tempo()
-            if tempo and tempo > 0:
+            tempo, confidence = self.bd_demo.get_tempo()
+            if tempo and tempo > 0 and confidence >= self.bd_demo.min_confidence:
                 self.song_demo.set_tempo(tempo)
+            else:
+                print(f"Unreliable tempo ({tempo}, confidence: {confidence:.2f}), keeping the song tempo")
             self.current_demo = self.song_demo
         self.current_demo.start()
 
     def run(self):
         self.running = True
+        self.start_keys()
         self.current_demo.start()
         try:
             while self.running:
@@ -60,28 +80,37 @@ class ShimonDemo:
 
     def stop(self):
         self.running = False
+        if self.keys_thread.is_alive() and self.keys_thread is not current_thread():
+            self.keys_thread.join()
         if self.qna_demo:
             self.qna_demo.stop()
         self.bd_demo.stop()
         self.song_demo.stop()
+        self.performer.stop()
 
     def reset(self):
         self.stop()
         self.keys.reset()
+        if self.qna_demo:
+            self.qna_demo.reset()  # Closes the transcription process and unlinks the shared ring buffer
 
 
-if __name__ == '__main__':
-    PHRASE_MIDI_FILES = [["phrases/intro.mid"], ["phrases/phrase_1A.mid", "phrases/phrase_1B.mid"],
-                         ["phrases/phrase_2A.mid", "phrases/phrase_2B.mid"],
-                         ["phrases/phrase_3A.mid", "phrases/phrase_3B.mid"], ["phrases/korvai.mid"]]
-    GESTURE_MIDI_FILES = [["gestures/intro.mid"], ["gestures/gestures_1A.mid", "gestures/gestures_1B.mid"],
-                          ["gestures/gestures_2A.mid", "gestures/gestures_2B.mid"],
-                          ["gestures/gestures_3A.mid", "gestures/gestures_3B.mid"], ["gestures/korvai.mid"]]
-    keyboard = "iRig KEYS 37"  # "iRig KEYS 37", "Vivo S1"
-    audio_interface = "HX Stomp"     # "HX Stomp", "Line 6 HX Stomp"
+PHRASE_MIDI_FILES = [["phrases/intro.mid"], ["phrases/phrase_1A.mid", "phrases/phrase_1B.mid"],
+                     ["phrases/phrase_2A.mid", "phrases/phrase_2B.mid"],
+                     ["phrases/phrase_3A.mid", "phrases/phrase_3B.mid"], ["phrases/korvai.mid"]]
+GESTURE_MIDI_FILES = [["gestures/intro.mid"], ["gestures/gestures_1A.mid", "gestures/gestures_1B.mid"],
+                      ["gestures/gestures_2A.mid", "gestures/gestures_2B.mid"],
+                      ["gestures/gestures_3A.mid", "gestures/gestures_3B.mid"], ["gestures/korvai.mid"]]
+KEYBOARD = "iRig KEYS 37"  # "iRig KEYS 37", "Vivo S1"
+AUDIO_INTERFACE = "HX Stomp"     # "HX Stomp", "Line 6 HX Stomp"
 
-    mode_key = 98
+MODE_KEY = 98
 
+
+def get_params(audio_interface=AUDIO_INTERFACE):
+    """
+    Parameters of the demos, as keyword arguments of ShimonDemo
+    """
     gesture_note_mapping = {
         "beatOnce": 50,
         "breath": 51,
@@ -103,36 +132,59 @@ if __name__ == '__main__':
         "osc_arm_route": "/arm",
         "osc_head_route": "/head",
         "min_note_dist_ms": 50,
-        "max_notes_per_onset": 4
+        "max_notes_per_onset": 4,
+        "lookahead_sec": 0.05,
+        "use_osc_bundles": False,   # True: chords and simultaneous gestures in one datagram, if the robot takes bundles
+        "bundle_lead_sec": 0        # > 0 sends timetagged bundles this early for receivers that schedule them
     }
 
     bd_params = {
         "smoothing": 4,
         "n_beats_to_track": 8,
         "timeout_sec": 2,
-        "tempo_range": (60, 120)
+        "tempo_range": (60, 120),
+        "min_confidence": 0.5,          # Tempo handed over to the song demo only above this
+        "source": "midi",               # "audio" tracks the beats of the violin input, "both" uses both
+        "latency_compensation_sec": 0   # Mechanical delay of the head bang
     }
 
     song_params = {
         "midi_files": PHRASE_MIDI_FILES,
         "gesture_midi_files": GESTURE_MIDI_FILES,
-        "start_note_for_phrase_mapping": 96
+        "start_note_for_phrase_mapping": 96,
+        "cache_dir": ".phrase_cache"
     }
 
-    # Pass 'None' to not filter audioToMidi by any raga
+    # Pass 'None' to not filter audioToMidi by any raga. A name from raga.RAGAS works too
     bahudari_map = [1, 0, 0, 0, 1, 1, 0, 1, 0, 0, 1, 0]
     qna_params = {
         "raga_map": bahudari_map,
+        "raga_policy": "snap",  # "snap" to the nearest note of the raga, "drop" the notes outside of it
         "sr": 16000,
         "frame_size": 2048,
         "activation_threshold": 0.01,
         "n_wait": 4,
         "input_dev_name": audio_interface,
+        "channels": 4,
+        "channel_map": 2,   # ch-3 of HX Stomp. A list or {channel: gain} dict downmixes several channels
         "outlier_filter_coeff": 2,
-        "timeout_sec": 0.5
+        "timeout_sec": 0.5,
+        "transcription_process": True,  # pyin and the onset network in a separate process, away from the callbacks
+        "adaptive_pitch_range": False,  # pyin searches around the recent register only, see benchmark.py
+        "response_midi_files": sum(PHRASE_MIDI_FILES, []),  # Library the keyboard answers are modelled on
+        "response_temperature": 1.0,
+        "speculative": True  # Transcribe during the n_wait silent blocks, so the answer is ready when the phrase ends
+    }
+
+    return {
+        "qna_param": qna_params,
+        "bd_param": bd_params,
+        "song_param": song_params,
+        "performer_param": performer_params
     }
 
+
+if __name__ == '__main__':
     # MidiInDevice.list_devices()
-    demo = ShimonDemo(keyboard, mode_key=mode_key, qna_param=qna_params,
-                      bd_param=bd_params, song_param=song_params, performer_param=performer_params)
+    demo = ShimonDemo(KEYBOARD, mode_key=MODE_KEY, **get_params())
     demo.run()
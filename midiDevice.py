@@ -3,18 +3,36 @@ Author: Raghavasimhan Sankaranarayanan
 Date: 04/08/2022
 """
 
+from collections import deque
+from threading import Event
 import rtmidi
 from rtmidi import midiutil
+import timing
 
 
 class MidiInDevice:
-    def __init__(self, name, callback_fn=None, user_data=None):
+    """
+    Keyboard input with the arrival time of every message on the timing.now() clock. With a callback_fn the messages
+    are handed to it as (message, timestamp, user_data) as they arrive; without one they wait in a queue of the last
+    `queue_size` messages for drain(), wait() blocks until there are some.
+    """
+    def __init__(self, name, callback_fn=None, user_data=None, queue_size=1024, max_lag_sec=0.02, lag_window=16):
+        """
+        max_lag_sec, lag_window: the timestamps are moved forward when even the most prompt of the last `lag_window`
+        callbacks came more than `max_lag_sec` after its timestamp, i.e. when the summed deltas fell behind now()
+        """
         self.initialized = False
         self.midi_in = rtmidi.MidiIn(queue_size_limit=1024)
         self.input = None
         self.name = name
         self.callback_fn = callback_fn
         self.user_data = user_data
+        self.timestamp = None
+        self.queue = deque(maxlen=queue_size)  # (message, timestamp). Appends and pops need no lock
+        self.dropped = 0
+        self._queued = Event()
+        self.max_lag = max_lag_sec
+        self._lags = deque(maxlen=lag_window)
         if self.name in self.midi_in.get_ports():
             self.input, _ = midiutil.open_midiinput(self.name)
             self.input.ignore_types()
@@ -37,9 +55,41 @@ class MidiInDevice:
     def set_callback(self, callback_fn):
         self.callback_fn = callback_fn
 
+    def drain(self, max_events=None):
+        """
+        Queued (message, timestamp) pairs, oldest first, removed from the queue
+        """
+        n = len(self.queue) if max_events is None else min(max_events, len(self.queue))
+        return [self.queue.popleft() for _ in range(n)]
+
+    def wait(self, timeout=None):
+        """
+        Blocks until messages are queued, returns False on timeout. Call drain() after it returns.
+        """
+        queued = self._queued.wait(timeout)
+        self._queued.clear()  # Before draining: a message queued from here on sets it again
+        return queued or len(self.queue) > 0
+
     @staticmethod
     def callback(msg, dev):
-        dev.callback_fn(msg[0], msg[1], dev.user_data)
+        # rtmidi delivers the time since the previous message. Summing the deltas gives the arrival times without the
+        # callback's scheduling jitter, clamped to now() so that a late first callback does not offset the rest.
+        # A late callback (GIL, scheduling) does not move the timestamps, but a lag that no callback makes up for is
+        # drift of the summed deltas and the timestamps are re-anchored to now().
+        message, delta = msg
+        now = timing.now()
+        dev.timestamp = now if dev.timestamp is None else min(dev.timestamp + delta, now)
+        dev._lags.append(now - dev.timestamp)
+        if len(dev._lags) == dev._lags.maxlen and min(dev._lags) > dev.max_lag:
+            dev.timestamp = now
+            dev._lags.clear()
+        if dev.callback_fn is not None:
+            dev.callback_fn(message, dev.timestamp, dev.user_data)
+            return
+        if len(dev.queue) == dev.queue.maxlen:
+            dev.dropped += 1
+        dev.queue.append((message, dev.timestamp))
+        dev._queued.set()
 
 
 class MidiOutDevice:
@@ -1,2 +1,30 @@
 from pythonosc import udp_client
+from pythonosc import osc_bundle_builder, osc_message_builder
 
+
+class OscSender(udp_client.SimpleUDPClient):
+    """
+    OSC client that sends the messages sharing a timestamp as one bundle (one datagram) with use_bundles=True.
+    By default every message is its own datagram, as expected by receivers that do not support bundles.
+    """
+    def __init__(self, address: str, port: int, use_bundles: bool = False, allow_broadcast: bool = False):
+        super().__init__(address, port, allow_broadcast)
+        self.use_bundles = use_bundles
+
+    def send_messages(self, messages: [(str, list)], timetag: float or None = None):
+        """
+        messages: list of (route, args)
+        timetag: wall clock time (time.time()) at which the receiver should apply the bundle, None for immediately
+        """
+        if not self.use_bundles or (len(messages) == 1 and timetag is None):
+            for route, args in messages:
+                self.send_message(route, args)
+            return
+
+        bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY if timetag is None else timetag)
+        for route, args in messages:
+            msg = osc_message_builder.OscMessageBuilder(address=route)
+            for arg in args:
+                msg.add_arg(arg)
+            bundle.add_content(msg.build())
+        self.send(bundle.build())
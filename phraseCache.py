@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# Compiled phrase: one row per OSC event, sorted by time (seconds from the phrase start at the file tempo)
+EVENT_DTYPE = np.dtype([('time', 'f8'), ('route', 'u1'), ('pitch', 'u1'), ('velocity', 'u1')])
+ROUTE_ARM = 0
+ROUTE_HEAD = 1
+
+# Bump when the compiled format or the compile step changes to invalidate old cache entries
+CACHE_VERSION = 1
+
+
+class PhraseCache:
+    """
+    On-disk cache of compiled phrases. Entries are keyed by the names (which set the phrase's role, e.g. korvai) and
+    content of the source files and by the compile parameters, the event array is stored as .npy (loaded memory mapped)
+    next to a small json file for the metadata.
+    """
+    def __init__(self, cache_dir: str = ".phrase_cache"):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(files: [str], params: dict) -> str:
+        h = hashlib.sha1(f"v{CACHE_VERSION}".encode())
+        for file in files:
+            if file is None:
+                h.update(b"-")
+                continue
+            h.update(os.path.basename(file).encode() + b"\0")
+            with open(file, 'rb') as f:
+                h.update(f.read())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".npy", base + ".json"
+
+    def load(self, key: str):
+        events_path, meta_path = self._paths(key)
+        if not (os.path.exists(events_path) and os.path.exists(meta_path)):
+            return None, None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            events = np.load(events_path, mmap_mode='r')
+        except (ValueError, OSError) as e:
+            print(f"Warning: ignoring corrupt phrase cache entry {key}: {e}")
+            return None, None
+        if events.dtype != EVENT_DTYPE:
+            return None, None
+        return events, meta
+
+    def save(self, key: str, events: np.ndarray, meta: dict):
+        events_path, meta_path = self._paths(key)
+        # Write to temporary files first so that an interrupted save never leaves a half written entry
+        np.save(events_path + ".tmp.npy", events)
+        with open(meta_path + ".tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(events_path + ".tmp.npy", events_path)
+        os.replace(meta_path + ".tmp", meta_path)
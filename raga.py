@@ -0,0 +1,79 @@
+import json
+import numpy as np
+
+# Pitch classes of the ragas from the root, 1 if the note belongs to the raga
+RAGAS = {
+    "bahudari": [1, 0, 0, 0, 1, 1, 0, 1, 0, 0, 1, 0],
+    "mohanam": [1, 0, 1, 0, 1, 0, 0, 1, 0, 1, 0, 0],
+    "shankarabharanam": [1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1],
+    "mayamalavagowla": [1, 1, 0, 0, 1, 1, 0, 1, 1, 0, 0, 1],
+}
+
+SNAP = "snap"
+DROP = "drop"
+
+
+def load_ragas(path: str):
+    """
+    Add the ragas of a json file {name: [12 x 0/1]} to RAGAS
+    """
+    with open(path) as f:
+        ragas = json.load(f)
+    for name, raga_map in ragas.items():
+        if len(raga_map) != 12:
+            raise ValueError(f"Raga {name} needs 12 pitch classes, got {len(raga_map)}")
+        RAGAS[name] = raga_map
+
+
+class RagaTable:
+    """
+    Lookup table from a MIDI pitch, in steps of `cents_resolution`, to the note of the raga it is played as:
+    snap - the nearest note of the raga, or dropped if further than `max_snap_cents` (None: never dropped)
+    drop - the nearest semitone if it belongs to the raga, dropped otherwise
+    Dropped pitches map to -1. Converting a phrase is a single indexed gather whatever the raga.
+    """
+    def __init__(self, raga_map, root: int, policy: str = SNAP, cents_resolution: int = 10, max_snap_cents=None):
+        if isinstance(raga_map, str):
+            raga_map = RAGAS[raga_map]
+        if policy not in (SNAP, DROP):
+            raise ValueError(f"Unknown raga policy {policy}")
+        self.root = root
+        self.policy = policy
+        self.steps = 100 // cents_resolution  # Table entries per semitone
+
+        pitch_class = (np.arange(128) - root) % 12
+        allowed = np.flatnonzero(np.asarray(raga_map)[pitch_class] == 1)
+        self.notes = allowed  # MIDI pitches of the raga
+        grid = np.arange(128 * self.steps) / self.steps
+        if policy == SNAP:
+            i = np.clip(np.searchsorted(allowed, grid), 1, len(allowed) - 1)
+            lower, upper = allowed[i - 1], allowed[i]
+            table = np.where(grid - lower <= upper - grid, lower, upper)
+            if max_snap_cents is not None:
+                table[np.abs(grid - table) * 100 > max_snap_cents] = -1
+        else:
+            table = np.rint(grid).astype(int)
+            table[~np.isin(table, allowed)] = -1
+        self.table = table.astype(np.int16)
+
+    def __call__(self, pitch: np.ndarray):
+        """
+        Returns the raga notes of the (fractional) MIDI pitches and the mask of the ones that are kept
+        """
+        idx = np.clip(np.rint(np.asarray(pitch) * self.steps), 0, len(self.table) - 1).astype(int)
+        notes = self.table[idx]
+        return notes, notes >= 0
+
+
+_tables = {}
+
+
+def get_raga_table(raga_map, root: int, policy: str = SNAP, cents_resolution: int = 10, max_snap_cents=None):
+    """
+    Tables are built once per root, raga and policy and shared
+    """
+    raga = raga_map if isinstance(raga_map, str) else tuple(raga_map)
+    key = (raga, root, policy, cents_resolution, max_snap_cents)
+    if key not in _tables:
+        _tables[key] = RagaTable(raga_map, root, policy, cents_resolution, max_snap_cents)
+    return _tables[key]
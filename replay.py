@@ -0,0 +1,262 @@
+"""
+Offline replay of a performance: the violin comes from a WAV file, the keyboard from a MIDI file (SMF) or a
+JSON-lines file of {"time": sec, "msg": [status, data1, data2]} and the OSC messages for Shimon are captured by a local
+UDP sink. The whole QnA -> beat detection -> song pipeline runs headless, no audio interface, keyboard or robot needed.
+
+python replay.py --wav violin.wav --keys keys.mid --speed 1 --out osc.jsonl
+
+Only --speed 1 times the real pipeline. --speed divides the input timestamps only: the QnA keyboard timeout, the beat
+detection timeout and the song playback still run in real time, so keyboard phrases are split differently and the tempo
+handed to the song demo is `speed` times the recorded one. Use other speeds to check the flow, not the timing.
+"""
+
+import argparse
+import json
+import socket
+from collections import deque
+from functools import partial
+from threading import Thread, Event
+
+import numpy as np
+import soundfile as sf
+import mido
+from pythonosc import osc_packet
+
+import timing
+from audioDevice import AudioDevice
+from main import ShimonDemo, get_params, MODE_KEY
+from tracer import get_tracer
+
+
+class FileAudioDevice(AudioDevice):
+    """
+    Drop-in replacement of AudioDevice that plays `path` to the callback, one frame every frame_size / rate / speed
+    seconds. The file must be 16-bit compatible and recorded at `rate`. A mono file is used as is whatever the channel
+    map, otherwise it must have `channels` channels. `pad_sec` of silence is appended so the last phrase ends.
+    """
+    def __init__(self, callback_fn, rate=16000, frame_size=1024, input_dev_name=None, channels=1, channel_map=None,
+                 path=None, speed=1.0, pad_sec=2.0):
+        if path is None:
+            raise AssertionError("No audio file to replay")
+
+        data, file_rate = sf.read(path, dtype='int16', always_2d=True)
+        if file_rate != rate:
+            raise ValueError(f"{path} is sampled at {file_rate} Hz, expected {rate} Hz")
+        if data.shape[1] == 1:
+            channels, channel_map = 1, (None if channel_map is None else 0)
+        elif data.shape[1] != channels:
+            raise ValueError(f"{path} has {data.shape[1]} channels, expected 1 or {channels}")
+
+        super().__init__(callback_fn, rate=rate, frame_size=frame_size, input_dev_name=input_dev_name,
+                         channels=channels, channel_map=channel_map)
+        self.speed = speed
+
+        n_frames = int(np.ceil(len(data) / frame_size + pad_sec * rate / frame_size))
+        self.data = np.zeros((n_frames * frame_size, channels), dtype=np.int16)
+        self.data[:len(data)] = data
+        self.idx = 0
+        self.finished = Event()
+        self._running = Event()
+        self._stopped = False
+        self.thread = Thread(target=self._run, name="FileAudioDevice", daemon=True)
+        self.thread.start()
+
+    def _open(self, input_dev_name):
+        pass  # No audio interface, the frames come from the file
+
+    def _run(self):
+        period = self.frame_size / self.rate / self.speed
+        deadline = None
+        while not self._stopped and self.idx < len(self.data):
+            if not self._running.is_set():
+                self._running.wait()
+                deadline = None
+                continue
+            deadline = timing.now() if deadline is None else deadline + period
+            timing.sleep_until(deadline)
+            frame = self.data[self.idx:self.idx + self.frame_size]
+            self.idx += self.frame_size
+            self._callback(frame.tobytes(), self.frame_size, {'input_buffer_adc_time': deadline}, 0)
+        self.finished.set()
+
+    def is_active(self):
+        return self._running.is_set() and not self.finished.is_set()
+
+    def start(self):
+        self._running.set()
+
+    def stop(self):
+        self._running.clear()
+
+    def reset(self):
+        self._stopped = True
+        self._running.set()
+
+
+class FileMidiInDevice:
+    """
+    Drop-in replacement of MidiInDevice that sends the events of `path` (.mid or JSON-lines) to the callback at their
+    time divided by `speed`, with the same timestamps as MidiInDevice. Playback starts with start().
+    """
+    def __init__(self, name, callback_fn=None, user_data=None, path=None, speed=1.0, queue_size=1024):
+        self.name = name
+        self.callback_fn = callback_fn
+        self.user_data = user_data
+        self.speed = speed
+        self.timestamp = None
+        self.events = self.load(path) if path else []
+        self.queue = deque(maxlen=queue_size)
+        self.dropped = 0
+        self._queued = Event()
+        self.initialized = True
+        self.finished = Event()
+        self._stop_event = Event()
+        self.thread = Thread(target=self._run, name="FileMidiInDevice", daemon=True)
+
+    @staticmethod
+    def load(path: str) -> [(float, list)]:
+        if path.endswith(".mid") or path.endswith(".midi"):
+            events = []
+            t = 0
+            for msg in mido.MidiFile(path):  # Iterating a MidiFile gives the delta times in seconds
+                t += msg.time
+                if not msg.is_meta:
+                    events.append((t, msg.bytes()))
+            return events
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        return sorted(((e["time"], e["msg"]) for e in events), key=lambda e: e[0])
+
+    @staticmethod
+    def list_devices():
+        print([])
+
+    def set_callback(self, callback_fn):
+        self.callback_fn = callback_fn
+
+    def drain(self, max_events=None):
+        n = len(self.queue) if max_events is None else min(max_events, len(self.queue))
+        return [self.queue.popleft() for _ in range(n)]
+
+    def wait(self, timeout=None):
+        queued = self._queued.wait(timeout)
+        self._queued.clear()
+        return queued or len(self.queue) > 0
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        start = timing.now()
+        for t, msg in self.events:
+            deadline = start + t / self.speed
+            if not timing.sleep_until(deadline, stop_event=self._stop_event):
+                break
+            self.timestamp = deadline
+            if self.callback_fn is not None:
+                self.callback_fn(msg, deadline, self.user_data)
+                continue
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((msg, deadline))
+            self._queued.set()
+        self.finished.set()
+
+    def reset(self):
+        self._stop_event.set()
+
+
+class OscSink:
+    """
+    UDP server in place of the robot, records every received OSC message with its arrival time (timing.now() clock)
+    """
+    def __init__(self, address="127.0.0.1", port=20000):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.1)
+        self.messages = []  # (arrival time, route, params)
+        self._stop_event = Event()
+        self.thread = Thread(target=self._run, name="OscSink", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                data, _ = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            t = timing.now()
+            try:
+                packet = osc_packet.OscPacket(data)
+            except osc_packet.ParseError as e:
+                print(f"Warning: dropped invalid OSC packet: {e}")
+                continue
+            for timed_msg in packet.messages:
+                self.messages.append((t, timed_msg.message.address, list(timed_msg.message.params)))
+
+    def stop(self):
+        self._stop_event.set()
+        self.thread.join()
+        self.sock.close()
+
+    def summary(self):
+        routes = {}
+        for _, route, _ in self.messages:
+            routes[route] = routes.get(route, 0) + 1
+        return routes
+
+    def export(self, path: str, t0: float = 0):
+        with open(path, 'w') as f:
+            for t, route, params in self.messages:
+                f.write(json.dumps({"time": t - t0, "route": route, "params": params}) + "\n")
+
+
+def replay(wav: str = None, keys: str = None, speed: float = 1.0, tail_sec: float = 5, out: str = None,
+           trace: str = None):
+    if speed != 1:
+        print(f"Warning: --speed {speed} only speeds up the inputs, the timeouts and the song playback stay real time. "
+              f"Only --speed 1 is representative of the timing")
+    params = get_params()
+    performer_params = params["performer_param"]
+    sink = OscSink(performer_params["osc_address"], performer_params["osc_port"])
+
+    params["qna_param"]["audio_device_cls"] = partial(FileAudioDevice, path=wav, speed=speed)
+    demo = ShimonDemo("replay", mode_key=MODE_KEY, midi_device_cls=partial(FileMidiInDevice, path=keys, speed=speed),
+                      **params)
+    t0 = timing.now()
+    demo.running = True
+    demo.start_keys()
+    demo.current_demo.start()
+    demo.keys.start()
+
+    try:
+        demo.keys.finished.wait()
+        audio = demo.qna_demo.audioDevice
+        while audio and audio.is_active():  # Stops early when the QnA demo is left before the end of the file
+            audio.finished.wait(0.1)
+        timing.sleep_until(timing.now() + tail_sec)
+    except KeyboardInterrupt:
+        pass
+
+    demo.reset()
+    sink.stop()
+
+    print(f"Replay took {timing.now() - t0:.2f} s, OSC messages: {sink.summary()}")
+    if out:
+        sink.export(out, t0)
+    if trace:
+        get_tracer().export(trace)
+    return sink
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded violin audio and keyboard MIDI through the demos")
+    parser.add_argument("--wav", help="violin recording (at the QnA sample rate)")
+    parser.add_argument("--keys", help="keyboard events, .mid or JSON-lines")
+    parser.add_argument("--speed", type=float, default=1.0, help="> 1 feeds the inputs faster than real time, timing is only representative at 1")
+    parser.add_argument("--tail", type=float, default=5, help="seconds to keep running after the inputs end")
+    parser.add_argument("--out", help="JSON-lines file for the captured OSC messages")
+    parser.add_argument("--trace", help="JSON-lines file for the stage timestamps of every phrase")
+    args = parser.parse_args()
+    replay(args.wav, args.keys, args.speed, args.tail, args.out, args.trace)
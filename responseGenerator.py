@@ -0,0 +1,85 @@
+import numpy as np
+import pretty_midi
+from raga import RAGAS
+
+
+class ResponseGenerator:
+    """
+    Varies a phrase by re-drawing some of its notes from a pitch class infill model P(note | previous, next), trained
+    on a MIDI library and restricted to the raga. The model is a dense 12 x 12 x 12 table of log probabilities, an
+    interpolation of the trigram, bigram and unigram counts; a whole response is drawn in one vectorized pass.
+    """
+    def __init__(self, raga_map=None, root: int = 50, midi_files: [str] = None, smoothing: float = 0.5,
+                 weights=(0.6, 0.3, 0.1), out_of_raga_prob: float = 1e-4, seed: int = None):
+        if isinstance(raga_map, str):
+            raga_map = RAGAS[raga_map]
+        self.root = root
+        self.raga_mask = np.ones(12) if raga_map is None else np.asarray(raga_map, dtype=float)
+        self.smoothing = smoothing
+        self.weights = weights
+        self.out_of_raga_prob = out_of_raga_prob
+        self.rng = np.random.default_rng(seed)
+        self.counts = np.zeros((12, 12, 12))  # [previous, next, note]
+        self.log_prob = None
+        if midi_files:
+            self.train(midi_files)
+        else:
+            self._update()
+
+    def train(self, midi_files: [str]):
+        for midi_file in midi_files:
+            midi_data = pretty_midi.PrettyMIDI(midi_file)
+            notes = sorted((n for inst in midi_data.instruments if not inst.is_drum for n in inst.notes),
+                           key=lambda n: (n.start, -n.pitch))
+            self.add_sequence(np.array([n.pitch for n in notes]))
+        self._update()
+
+    def add_sequence(self, pitches: np.ndarray):
+        pc = (np.asarray(pitches) - self.root) % 12
+        if len(pc) >= 3:
+            np.add.at(self.counts, (pc[:-2], pc[2:], pc[1:-1]), 1)
+
+    def _update(self):
+        def normalize(x):
+            x = x + self.smoothing
+            return x / x.sum(axis=-1, keepdims=True)
+
+        trigram = normalize(self.counts)
+        bigram = normalize(self.counts.sum(axis=1))[:, None, :]  # P(note | previous)
+        unigram = normalize(self.counts.sum(axis=(0, 1)))[None, None, :]
+        w3, w2, w1 = self.weights
+        prob = w3 * trigram + w2 * bigram + w1 * unigram
+        prob = prob * np.where(self.raga_mask > 0, 1, self.out_of_raga_prob)
+        self.log_prob = np.log(prob / prob.sum(axis=-1, keepdims=True))
+
+    def save(self, path: str):
+        np.savez(path, counts=self.counts, raga_mask=self.raga_mask, root=self.root)
+
+    def load(self, path: str):
+        data = np.load(path)
+        self.counts, self.raga_mask, self.root = data["counts"], data["raga_mask"], int(data["root"])
+        self._update()
+
+    def respond(self, pitches: np.ndarray, temperature: float = 1.0) -> np.ndarray:
+        """
+        New pitches for the phrase. Up to `temperature` (0 - 1) of the notes change, mostly in the middle of the
+        phrase, each drawn given the original notes around it (sharper for a low temperature) and kept in the octave
+        closest to the note it replaces.
+        """
+        pitches = np.array(pitches, dtype=int)
+        n = len(pitches)
+        temperature = max(min(temperature, 1), 0)
+        n_change = self.rng.integers(0, int(n * temperature) + 1) if n > 2 else 0
+        if n_change == 0:
+            return pitches
+
+        w = np.hanning(n) + 1e-6
+        idx = self.rng.choice(n, n_change, replace=False, p=w / np.sum(w))
+        pc = (pitches - self.root) % 12
+        prev, nxt = pc[np.maximum(idx - 1, 0)], pc[np.minimum(idx + 1, n - 1)]
+
+        # Gumbel-max: one argmax draws every note from its softmax
+        logits = self.log_prob[prev, nxt] / max(temperature, 0.05)
+        new_pc = np.argmax(logits + self.rng.gumbel(size=logits.shape), axis=1)
+        pitches[idx] += (new_pc - pc[idx] + 6) % 12 - 6
+        return pitches
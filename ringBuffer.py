@@ -0,0 +1,73 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated single-producer / single-consumer sample buffer.
+    Every sample is stored twice (at i and i + capacity) so that any window of up to `capacity` samples can be read
+    back as a contiguous, zero-copy view. Positions are absolute sample counts. The producer only advances `count`
+    after the samples are in place, so the consumer never needs a lock to read what has been published.
+
+    shared=True puts the samples and the count in shared memory, another process attaches to it with `name`.
+    The creator owns the memory and frees it in close().
+    """
+    def __init__(self, capacity: int, dtype=np.float32, shared: bool = False, name: str = None):
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.shm = None
+        self._owner = False
+        if shared or name is not None:
+            size = 8 + 2 * capacity * self.dtype.itemsize  # int64 count, then the samples
+            self._owner = name is None
+            self.shm = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+            self._count = np.ndarray(1, dtype=np.int64, buffer=self.shm.buf)
+            self.buffer = np.ndarray(2 * capacity, dtype=self.dtype, buffer=self.shm.buf, offset=8)
+            if self._owner:
+                self._count[0] = 0
+                self.buffer[:] = 0
+        else:
+            self._count = np.zeros(1, dtype=np.int64)
+            self.buffer = np.zeros(2 * capacity, dtype=self.dtype)
+
+    @property
+    def name(self):
+        return self.shm.name if self.shm else None
+
+    @property
+    def count(self) -> int:
+        return int(self._count[0])
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def write(self, x: np.ndarray):
+        n = len(x)
+        if n > self.capacity:
+            raise ValueError(f"Block of {n} samples does not fit in a ring buffer of {self.capacity}")
+
+        i = self.count % self.capacity
+        for start in (i, i + self.capacity):
+            end = min(start + n, 2 * self.capacity)
+            np.copyto(self.buffer[start:end], x[:end - start])
+            if end - start < n:
+                np.copyto(self.buffer[:n - (end - start)], x[end - start:])
+        self._count[0] += n
+
+    def view(self, start: int, end: int) -> np.ndarray:
+        count = self.count
+        if start < count - self.capacity or end > count or end - start > self.capacity:
+            raise ValueError(f"Samples [{start}, {end}) are not available in the ring buffer")
+        i = start % self.capacity
+        return self.buffer[i:i + end - start]
+
+    def close(self):
+        if self.shm is None:
+            return
+        # The arrays must go before the mapping can be closed
+        self._count = np.array([self.count], dtype=np.int64)
+        self.buffer = np.zeros(0, dtype=self.dtype)
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+        self.shm = None
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import threading
+import traceback
+import math
+import timing
+
+
+class Handle:
+    def __init__(self, deadline: float, fn, args, period: float = None):
+        self.deadline = deadline
+        self.fn = fn
+        self.args = args
+        self.period = period  # Can be changed while running, applies from the next call
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    A single long-lived thread that runs callbacks at absolute deadlines (timing.now() clock) taken from a time-ordered
+    queue. Events with the same deadline run in the order they were scheduled. The thread sleeps on a condition until
+    `spin_sec` before the next deadline and busy-waits the rest. Callbacks should return quickly, anything long belongs
+    to a worker thread.
+    """
+    def __init__(self, name: str = "Scheduler", spin_sec: float = 1e-3):
+        self.name = name
+        self.spin_sec = spin_sec
+        self._queue = []
+        self._counter = itertools.count()
+        self._cv = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def call_at(self, deadline: float, fn, *args) -> Handle:
+        handle = Handle(deadline, fn, args)
+        self._push(handle)
+        return handle
+
+    def call_later(self, delay: float, fn, *args) -> Handle:
+        return self.call_at(timing.now() + delay, fn, *args)
+
+    def call_every(self, period: float, fn, *args, start: float = None) -> Handle:
+        """
+        Call fn every `period` seconds from `start` (default: one period from now) until the handle is cancelled.
+        The deadlines are start + k * period, they do not drift with the callback duration.
+        """
+        handle = Handle(timing.now() + period if start is None else start, fn, args, period)
+        self._push(handle)
+        return handle
+
+    def _push(self, handle: Handle):
+        with self._cv:
+            heapq.heappush(self._queue, (handle.deadline, next(self._counter), handle))
+            self._cv.notify()
+
+    def clear(self):
+        with self._cv:
+            for _, _, handle in self._queue:
+                handle.cancel()
+            self._queue = []
+            self._cv.notify()
+
+    def stop(self):
+        with self._cv:
+            self._running = False
+            self._cv.notify()
+        if self._thread.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while self._running:
+                    if self._queue:
+                        timeout = self._queue[0][0] - timing.now() - self.spin_sec
+                        if timeout <= 0:
+                            break
+                        self._cv.wait(timeout)
+                    else:
+                        self._cv.wait()
+                if not self._running:
+                    return
+                deadline, _, handle = heapq.heappop(self._queue)
+
+            while timing.now() < deadline:
+                pass
+            if handle.cancelled:
+                continue
+            try:
+                handle.fn(*handle.args)
+            except Exception:
+                print(f"Warning: {self.name} callback failed")
+                traceback.print_exc()
+
+            if handle.period and not handle.cancelled:
+                handle.deadline += handle.period
+                now = timing.now()
+                if handle.deadline < now:  # Missed periods are skipped, the phase is kept
+                    handle.deadline += math.ceil((now - handle.deadline) / handle.period) * handle.period
+                self._push(handle)
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def shared_scheduler() -> Scheduler:
+    """
+    Process wide scheduler for watchdogs and periodic gestures, started on first use
+    """
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = Scheduler("Shared scheduler")
+        return _shared_scheduler
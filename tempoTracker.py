@@ -1,51 +1,148 @@
-import time
+import math
 import numpy as np
-import threading
+import timing
+from scheduler import shared_scheduler
+
+
+class BeatPredictor:
+    """
+    Phase-locked loop on the note-on times. The period comes from the tempo estimate; every onset within `capture`
+    periods of a predicted beat pulls the beat phase (alpha) and the period (beta) towards it. Onsets further away
+    (off-beats, grace notes) do not move the loop. Times are on the timing.now() clock.
+    """
+    def __init__(self, alpha=0.5, beta=0.1, capture=0.25):
+        self.alpha = alpha
+        self.beta = beta
+        self.capture = capture
+        self.period = None
+        self.beat = None  # Time of the latest beat
+
+    def reset(self):
+        self.period = None
+        self.beat = None
+
+    def set_period(self, period):
+        self.period = period
+
+    def update(self, t):
+        if self.beat is None or self.period is None:
+            self.beat = t
+            return
+
+        k = round((t - self.beat) / self.period)
+        error = t - (self.beat + k * self.period)
+        if abs(error) > self.capture * self.period:
+            return
+        self.beat = self.beat + k * self.period + self.alpha * error
+        self.period += self.beta * error / max(k, 1)
+
+    def next_beat(self, after):
+        if self.beat is None or self.period is None:
+            return None
+        return self.beat + max(0, math.ceil((after - self.beat) / self.period)) * self.period
 
 
 class TempoTracker:
-    def __init__(self, n_beats_to_track=8, smoothing=5, timeout_sec=5, timeout_callback=None, tempo_range=(60, 120), default_tempo=80):
+    """
+    Tempo from the note-on timestamps (timing.now() clock, see MidiInDevice). The last `history_size` onsets are kept
+    and every pair of them votes for the candidate beat periods it is a whole multiple of, so a stray grace note or a
+    jittery interval only adds a few off-grid pairs instead of moving the estimate. At least `smoothing` intervals are
+    needed before a tempo is reported. The confidence (0 - 1) is the share of the pair votes that fit the chosen grid or
+    one of its `subdivisions`, so steady eighths, triplets or dotted rhythms are as confident as quarter notes.
+    """
+    def __init__(self, n_beats_to_track=8, smoothing=5, timeout_sec=5, timeout_callback=None, tempo_range=(60, 120), default_tempo=80,
+                 scheduler=None, history_size=24, min_ioi_sec=0.1, max_span_beats=4, tolerance=0.06, resolution_bpm=0.5,
+                 subdivisions=(1, 2, 3, 4)):
         self.smoothing = smoothing
         self.timeout = timeout_sec
         self.history = None
         self.idx = 0
         self.tempo = default_tempo
+        self.confidence = 0
         self.num_out = 0
-        self.last_time = time.time()
+        self.last_time = timing.now()
         self.first_time = True
         self.active = False
         self.timeout_callback = timeout_callback
         self.tempo_range = tempo_range
-
         self.n_beats = n_beats_to_track
-        self.event = threading.Event()
+        self.history_size = history_size
+        self.min_ioi = min_ioi_sec  # Closer onsets are chords / grace notes and count as one
+        self.max_span = max_span_beats * 60 / tempo_range[0]  # Pairs further apart than this do not vote
+        self.tolerance = tolerance  # Std of the deviation from the grid, in beats
+        self.periods = 60 / np.arange(tempo_range[0], tempo_range[1], resolution_bpm)
+        self.subdivisions = np.array(subdivisions)[:, None]  # Of the beat, for the confidence
+        self.scheduler = scheduler if scheduler is not None else shared_scheduler()
+        self._timeout_handle = None
+        self.beat_predictor = BeatPredictor()
         self.reset_vars()
 
-    def track_tempo(self, note_on_msg, dt):
+    def track_tempo(self, note_on_msg, timestamp=None):
         if not self.active:
             self.reset_vars()
             return None
 
-        if self.first_time:
-            self.last_time = time.time()
-            self.first_time = False
+        if timestamp is None:
+            timestamp = timing.now()
 
-        new_time = time.time() - self.last_time
-        if new_time < 100e-3:
+        if not self.first_time and timestamp - self.last_time < self.min_ioi:
             return None
+        self.first_time = False
 
-        self.last_time = time.time()
-        self.history[self.idx] = self.wrap_tempo(60/new_time)
-
+        self.last_time = timestamp
+        self.beat_predictor.update(timestamp)
+        self.history[self.idx] = timestamp
         self.idx = (self.idx + 1) % len(self.history)
-        if self.num_out > 3:
-            t = np.nanmean(self.history)
-            if self.num_out < self.n_beats:
-                self.tempo = t
         self.num_out += 1
 
+        if self.num_out > self.smoothing and self.num_out <= self.n_beats + 1:
+            tempo, confidence = self.estimate_tempo(self.history)
+            if tempo:
+                self.tempo, self.confidence = tempo, confidence
+                self.beat_predictor.set_period(60 / tempo)
+
         return self.tempo
 
+    def estimate_tempo(self, onsets: np.ndarray):
+        """
+        Returns (tempo, confidence) for the onset times, (None, 0) if there are not enough of them
+        """
+        t = np.sort(onsets[~np.isnan(onsets)])
+        if len(t) < 3:
+            return None, 0
+
+        i, j = np.triu_indices(len(t), 1)
+        ioi = t[j] - t[i]
+        ioi = ioi[ioi <= self.max_span]
+        if len(ioi) == 0:
+            return None, 0
+
+        # (candidates x pairs): how far each interval is from a whole number of beats
+        ratio = ioi[None, :] / self.periods[:, None]
+        k = np.round(ratio)
+        valid = k >= 1
+        weight = np.where(valid, 1 / np.maximum(k, 1), 0)  # Neighbouring onsets matter more than distant ones
+        score = (weight * np.exp(-0.5 * ((ratio - k) / self.tolerance) ** 2)).sum(axis=1)
+        best = int(np.argmax(score))
+        total = weight[best].sum()
+        if total == 0:
+            return None, 0
+
+        # Refine the period with the intervals that are on the winning grid
+        on_grid = valid[best] & (np.abs(ratio[best] - k[best]) < 2 * self.tolerance)
+        period = np.sum(ioi[on_grid]) / np.sum(k[best][on_grid]) if np.any(on_grid) else self.periods[best]
+        tempo = self.wrap_tempo(60 / period)
+        if tempo is None:
+            return None, 0
+
+        # The pairs that voted, scored against the winning grid and its subdivisions (deviation in beats)
+        r = ratio[best][valid[best]]
+        sub = r[None, :] * self.subdivisions
+        deviation = np.min(np.abs(sub - np.round(sub)) / self.subdivisions, axis=0)
+        w = weight[best][valid[best]]
+        confidence = np.sum(w * np.exp(-0.5 * (deviation / self.tolerance) ** 2)) / total
+        return tempo, float(confidence)
+
     def wrap_tempo(self, tempo):
         min_bpm, max_bpm = self.tempo_range
         if min_bpm <= tempo < max_bpm:
@@ -64,27 +161,30 @@ class TempoTracker:
         return None
 
     def reset_vars(self):
-        self.history = np.zeros(self.smoothing, dtype=float)
+        self.history = np.full(self.history_size, np.nan)
         self.idx = 0
         self.num_out = 0
-        self.last_time = time.time()
+        self.confidence = 0
+        self.last_time = timing.now()
         self.first_time = True
+        self.beat_predictor.reset()
 
     def start(self):
+        self.reset_vars()
         self.active = True
-        self.event.clear()
-        self.check_timeout()
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+        self._timeout_handle = self.scheduler.call_every(1, self.check_timeout)
 
     def stop(self):
         self.active = False
-        self.event.set()
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
 
     def check_timeout(self):
-        if time.time() - self.last_time > self.timeout and not self.first_time:
+        if timing.now() - self.last_time > self.timeout and not self.first_time:
             print("timeout")
             self.stop()
             if self.timeout_callback is not None:
                 self.timeout_callback()
-
-        if not self.event.is_set():
-            threading.Timer(1, self.check_timeout).start()
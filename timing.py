@@ -0,0 +1,49 @@
+import time
+import numpy as np
+
+
+def now():
+    # Monotonic, high resolution clock used for every deadline
+    return time.perf_counter()
+
+
+def sleep_until(deadline: float, spin_sec: float = 1e-3, stop_event=None) -> bool:
+    """
+    Sleep until the absolute `deadline` (see now()). The OS sleep stops `spin_sec` early and the rest is busy-waited,
+    which removes the scheduler's wake-up overshoot. Returns False if `stop_event` got set while waiting.
+    """
+    remaining = deadline - now() - spin_sec
+    if remaining > 0:
+        if stop_event is not None:
+            if stop_event.wait(remaining):
+                return False
+        else:
+            time.sleep(remaining)
+    while now() < deadline:
+        pass
+    return stop_event is None or not stop_event.is_set()
+
+
+class TimingStats:
+    """
+    Lateness of the events of a phrase with respect to their deadlines
+    """
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.errors = []
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, deadline: float):
+        self.errors.append(now() - deadline)
+
+    def max(self):
+        return np.max(self.errors) if self.errors else 0
+
+    def mean(self):
+        return np.mean(self.errors) if self.errors else 0
+
+    def __str__(self):
+        return f"{self.name} timing error - max: {self.max() * 1000:.2f} ms, mean: {self.mean() * 1000:.2f} ms, " \
+               f"events: {len(self.errors)}"
@@ -0,0 +1,101 @@
+import itertools
+import json
+import threading
+import timing
+
+
+class Tracer:
+    """
+    Preallocated ring of (trace id, stage, time) marks on the timing.now() clock. mark() does not allocate or lock, so
+    it can be called from the audio callback. A trace follows one phrase from its input to its last OSC message; the
+    thread working on a phrase binds the trace with set_trace() and the stages it runs are marked without passing ids
+    around. Trace 0 collects the marks that do not belong to a phrase.
+    """
+    def __init__(self, capacity: int = 1 << 14, enabled: bool = True):
+        self.capacity = capacity
+        self.enabled = enabled
+        self._ids = [0] * capacity
+        self._stages = [None] * capacity
+        self._times = [0.] * capacity
+        self._index = itertools.count()  # next() is atomic, writers on different threads get different slots
+        self._trace_ids = itertools.count(1)
+        self._local = threading.local()
+
+    def new_trace(self) -> int:
+        return next(self._trace_ids)
+
+    def set_trace(self, trace_id: int):
+        self._local.trace_id = trace_id
+
+    def current_trace(self) -> int:
+        return getattr(self._local, 'trace_id', 0)
+
+    def mark(self, stage: str, trace_id: int = None, t: float = None):
+        if not self.enabled:
+            return
+        i = next(self._index) % self.capacity
+        self._times[i] = timing.now() if t is None else t
+        self._ids[i] = self.current_trace() if trace_id is None else trace_id
+        self._stages[i] = stage
+
+    def clear(self):
+        self._stages = [None] * self.capacity
+
+    def records(self, trace_id: int = None) -> [(int, str, float)]:
+        """
+        The marks still in the ring, in time order, only those of `trace_id` if given
+        """
+        records = [(i, s, t) for i, s, t in zip(self._ids, self._stages, self._times)
+                   if s is not None and (trace_id is None or i == trace_id)]
+        return sorted(records, key=lambda r: r[2])
+
+    def summary(self, trace_id: int) -> str:
+        """
+        Time of the first occurrence of each stage from the start of the trace, and from the previous stage.
+        Repeated stages (audio blocks, sends) also show their count and last occurrence
+        """
+        records = self.records(trace_id)
+        if not records:
+            return f"Trace {trace_id}: no marks"
+
+        stages = {}
+        for _, stage, t in records:
+            if stage in stages:
+                stages[stage][1] = t
+                stages[stage][2] += 1
+            else:
+                stages[stage] = [t, t, 1]
+
+        t0 = records[0][2]
+        prev = t0
+        lines = [f"Trace {trace_id}:"]
+        for stage, (first, last, count) in stages.items():
+            line = f"  {stage:<14} {(first - t0) * 1000:9.2f} ms  (+{(first - prev) * 1000:.2f} ms)"
+            if count > 1:
+                line += f"  x{count}, last at {(last - t0) * 1000:.2f} ms"
+            lines.append(line)
+            prev = first
+        return "\n".join(lines)
+
+    def export(self, path: str):
+        """
+        Write the marks as JSON-lines {"trace", "stage", "time"}
+        """
+        with open(path, 'w') as f:
+            for trace_id, stage, t in self.records():
+                f.write(json.dumps({"trace": trace_id, "stage": stage, "time": t}) + "\n")
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """
+    Process wide tracer shared by the audio, transcription and playback code
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            _tracer = Tracer()
+        return _tracer
@@ -0,0 +1,128 @@
+import multiprocessing as mp
+import queue
+import traceback
+
+import timing
+
+from audioToMidi import AudioMidiConverter
+from ringBuffer import RingBuffer
+from tracer import get_tracer
+
+
+class Transcriber:
+    """
+    AudioMidiConverter working on sample ranges of a RingBuffer, in the calling thread. The notes are returned as a
+    NOTE_DTYPE array with the onsets.
+    Same interface as TranscriptionProcess, for debugging and for machines where a second process does not pay off.
+    """
+    def __init__(self, ring: RingBuffer, converter_params: dict):
+        self.ring = ring
+        self.converter = AudioMidiConverter(**converter_params)
+
+    def reset_stream(self):
+        self.converter.reset_stream()
+
+    def process_block(self, start: int, end: int):
+        self.converter.process_block(self.ring.view(start, end))
+
+    def speculate(self):
+        self.converter.speculate()
+
+    def finish_stream(self):
+        return self.converter.finish_stream(return_onsets=True, as_array=True)
+
+    def convert(self, start: int, end: int):
+        return self.converter.convert(self.ring.view(start, end), return_onsets=True, as_array=True)
+
+    def close(self):
+        pass
+
+
+class TranscriptionProcess:
+    """
+    AudioMidiConverter in a persistent worker process, so that pyin and the onset network never hold the GIL of the
+    process running the audio and MIDI callbacks. The worker attaches to the shared memory of `ring` and only receives
+    sample ranges; it is started and warmed up (models loaded, first calls compiled) in the constructor.
+    Requests are served in order; finish_stream and convert block until the notes and onsets are back. The stage marks
+    of the worker are merged into this process's tracer under the trace of the calling thread.
+    """
+    def __init__(self, ring: RingBuffer, converter_params: dict, start_timeout_sec: float = 120):
+        if ring.name is None:
+            raise ValueError("TranscriptionProcess needs a shared RingBuffer")
+        self.tracer = get_tracer()
+        ctx = mp.get_context("spawn")  # A fork would copy the audio and MIDI threads' state
+        self._requests = ctx.Queue()
+        self._results = ctx.Queue()
+        self.process = ctx.Process(target=_serve, name="Transcription", daemon=True,
+                                   args=(ring.name, ring.capacity, ring.dtype.str, converter_params,
+                                         self._requests, self._results))
+        self.process.start()
+        self._get(start_timeout_sec)  # Ready
+
+    def reset_stream(self):
+        self._requests.put(("reset_stream", 0))
+
+    def process_block(self, start: int, end: int):
+        self._requests.put(("process_block", 0, start, end))
+
+    def speculate(self):
+        # Not waited for: the worker keeps the result for finish_stream, which is served after it
+        self._requests.put(("speculate", 0))
+
+    def finish_stream(self):
+        self._requests.put(("finish_stream", self.tracer.current_trace()))
+        return self._get()
+
+    def convert(self, start: int, end: int):
+        self._requests.put(("convert", self.tracer.current_trace(), start, end))
+        return self._get()
+
+    def _get(self, timeout: float = None):
+        deadline = None if timeout is None else timing.now() + timeout
+        while True:
+            try:
+                status, result, marks = self._results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive() or (deadline is not None and timing.now() > deadline):
+                    raise RuntimeError("Transcription process is not responding")
+        for trace_id, stage, t in marks:
+            self.tracer.mark(stage, trace_id, t)
+        if status == "error":
+            raise RuntimeError(f"Transcription failed:\n{result}")
+        return result
+
+    def close(self):
+        if self.process.is_alive():
+            self._requests.put(None)
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+def _serve(ring_name, capacity, dtype, converter_params, requests, results):
+    ring = RingBuffer(capacity, dtype, name=ring_name)
+    transcriber = Transcriber(ring, converter_params)  # Warms up pyin and the onset network
+    tracer = get_tracer()
+    results.put(("ok", None, []))
+
+    error = None  # A failure while streaming is reported with the result of the phrase
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        cmd, trace_id, *args = request
+        tracer.set_trace(trace_id)
+        result = None
+        try:
+            result = getattr(transcriber, cmd)(*args)
+        except Exception:
+            error = error or traceback.format_exc()
+        if cmd in ("finish_stream", "convert"):
+            marks = tracer.records()
+            tracer.clear()
+            results.put(("error", error, marks) if error else ("ok", result, marks))
+            if error:
+                transcriber.reset_stream()
+            error = None
+    ring.close()